@@ -3,22 +3,50 @@ import sys
 import time
 import json
 import shutil
+import fcntl
+import threading
 import requests
 import yaml
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # allow importing utils from repository root
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.fs import swap_symlink
 try:
     from utils import runner as runner_utils
 except Exception:
     runner_utils = None
+try:
+    from watchfiles import watch
+except Exception:
+    watch = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 WORKSPACE = os.environ.get('WORKSPACE', '/workspace')
 MANAGER_URL = os.environ.get('MANAGER_URL', 'http://manager:8080')
 MANAGER_API_TOKEN = os.environ.get('MANAGER_API_TOKEN')
 DEPLOY_DIR = os.path.join(WORKSPACE, 'deploy')
 TASKS_DIR = os.path.join(WORKSPACE, 'tasks')
+# Safety-net full sweep interval while watching for changes
+HOUSEKEEPING_INTERVAL = float(os.environ.get('DEPLOY_HOUSEKEEPING_INTERVAL', '60'))
+# inotify does not see changes made by other hosts on NFS-mounted workspaces
+FORCE_POLLING = os.environ.get('DEPLOY_FORCE_POLLING', '').lower() == 'true'
+# watch() wakes at least this often (ms) so the first sweep runs right after the watcher is
+# registered and housekeeping is time-based rather than waiting for an idle gap
+WATCH_TICK_MS = 1000
+CONCURRENCY = int(os.environ.get('DEPLOY_CONCURRENCY', '4'))
+# Touched by the manager whenever a task becomes deployable
+DEPLOY_PENDING_FILE = os.path.join(WORKSPACE, '.deploy_pending')
 
 os.makedirs(DEPLOY_DIR, exist_ok=True)
 
@@ -26,28 +54,123 @@ HEADERS = {}
 if MANAGER_API_TOKEN:
     HEADERS['Authorization'] = f"Bearer {MANAGER_API_TOKEN}"
 
-print('Deployment agent started. Deploy dir:', DEPLOY_DIR)
+_www_lock = threading.Lock()
+
+# Shared keep-alive pool for manager updates and acceptance probes. The manager token is
+# passed per call rather than set on the session so it never leaks to acceptance URLs.
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.2, backoff_max=2.0, backoff_jitter=0.2))
+session.mount('http://', _adapter)
+session.mount('https://', _adapter)
+
+# FICLONE ioctl (linux/fs.h): share extents on reflink-capable filesystems (btrfs, XFS)
+_FICLONE = 0x40049409
+
+
+def _reflink_copy(src, dst):
+    """copy_function for shutil.copytree: clone extents when the filesystem supports it,
+    otherwise fall back to a regular copy2."""
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return dst
+    except OSError:
+        return shutil.copy2(src, dst)
+
+
+def _link_or_copy(src, dst):
+    """copy_function that hardlinks deployed files (immutable once deployed); across devices it
+    clones or copies in-kernel via _reflink_copy (copy2 uses sendfile on Linux)."""
+    try:
+        os.link(src, dst)
+        return dst
+    except OSError:
+        return _reflink_copy(src, dst)
+
+
+def _read_json(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _dumps(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def _write_json(path, obj):
+    # Write beside the target and rename over it, so readers never see a truncated file.
+    # The temp name is per process and thread since several workers may write the same file.
+    data = _dumps(obj)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+# Parsed meta/spec per task dir, keyed on (mtime_ns, size) so unchanged files are not reparsed
+_meta_cache = {}
+_spec_cache = {}
+
 
 def read_meta(task_dir):
     meta_file = os.path.join(task_dir, 'meta.json')
-    if not os.path.exists(meta_file):
+    try:
+        st = os.stat(meta_file)
+    except FileNotFoundError:
+        _meta_cache.pop(task_dir, None)
         return None
-    with open(meta_file) as f:
-        return json.load(f)
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _meta_cache.get(task_dir)
+    if cached and cached[0] == key:
+        return cached[1]
+    meta = _read_json(meta_file)
+    _meta_cache[task_dir] = (key, meta)
+    return meta
+
+
+def read_spec(task_dir):
+    """Load spec.yaml, preferring the spec.cache.json sidecar while it is at least as new."""
+    spec_path = os.path.join(task_dir, 'spec.yaml')
+    cache_path = os.path.join(task_dir, 'spec.cache.json')
+    try:
+        st = os.stat(spec_path)
+    except FileNotFoundError:
+        _spec_cache.pop(task_dir, None)
+        return {}
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _spec_cache.get(task_dir)
+    if cached and cached[0] == key:
+        return cached[1]
+    spec = _load_spec(spec_path, cache_path, st.st_mtime)
+    _spec_cache[task_dir] = (key, spec)
+    return spec
+
+
+def _load_spec(spec_path, cache_path, spec_mtime):
+    try:
+        if os.stat(cache_path).st_mtime >= spec_mtime:
+            return _read_json(cache_path)
+    except (OSError, ValueError):
+        pass
+    with open(spec_path) as f:
+        spec = yaml.load(f, Loader=_SafeLoader) or {}
+    # Refresh the sidecar so later sweeps skip YAML parsing
+    try:
+        _write_json(cache_path, spec)
+    except Exception as e:
+        print('Failed to write spec cache for', os.path.basename(os.path.dirname(spec_path)), e)
+    return spec
 
 
 def write_deploy_record(task_dir, record):
-    records_file = os.path.join(task_dir, 'deploy_records.json')
-    records = []
-    if os.path.exists(records_file):
-        try:
-            with open(records_file) as f:
-                records = json.load(f)
-        except Exception:
-            records = []
-    records.append(record)
-    with open(records_file, 'w') as f:
-        json.dump(records, f)
+    """Append one record to the task's deploy_records.jsonl history (one JSON document per line)."""
+    records_file = os.path.join(task_dir, 'deploy_records.jsonl')
+    line = _dumps(record) + b'\n'
+    # a single O_APPEND write keeps concurrent appends from interleaving
+    with open(records_file, 'ab') as f:
+        f.write(line)
 
 
 def create_followup_task(task_id, reason):
@@ -62,11 +185,10 @@ def create_followup_task(task_id, reason):
             'priority': 'high'
         }
     }
-        try:
-                requests.post(f"{MANAGER_URL}/api/tasks", json=payload, timeout=5, headers=HEADERS)
-            except Exception as e:
-                print('Failed to create follow-up task', e)
-
+    try:
+        session.post(f"{MANAGER_URL}/api/tasks", json=payload, timeout=5, headers=HEADERS)
+    except Exception as e:
+        print('Failed to create follow-up task', e)
 
 
 def check_acceptance(task_dir, spec):
@@ -76,9 +198,15 @@ def check_acceptance(task_dir, spec):
         if isinstance(a, dict) and 'url' in a:
             url = a.get('url')
             expected = a.get('should_respond', 200)
+            # Only the status code matters, so probe with HEAD and skip the body transfer
+            any_2xx = expected == 200 and bool(a.get('accept_any_2xx', False))
             try:
-                r = requests.get(url, timeout=5)
-                if r.status_code == expected:
+                r = session.head(url, timeout=5, allow_redirects=True)
+                if r.status_code in (405, 501):
+                    # server does not support HEAD; fall back to a GET without reading the body
+                    r = session.get(url, timeout=5, stream=True)
+                    r.close()
+                if r.status_code == expected or (any_2xx and 200 <= r.status_code < 300):
                     return True, {'url': url, 'status_code': r.status_code}
                 else:
                     return False, {'url': url, 'status_code': r.status_code}
@@ -87,232 +215,289 @@ def check_acceptance(task_dir, spec):
     # No URL-based acceptance criteria: consider verified
     return True, {'info': 'no_url_checks'}
 
-while True:
+def handle_task(task_dir):
+    name = os.path.basename(task_dir)
+    meta = read_meta(task_dir)
+    if not meta:
+        return
+    status = meta.get('status')
+    # Consider tasks that are completed or explicitly ready for deploy
+    if status not in ('completed', 'ready_for_deploy'):
+        return
+    # Check task spec for deploy flag
+    deploy_flag = False
+    spec = {}
     try:
-        for name in os.listdir(TASKS_DIR):
-            task_dir = os.path.join(TASKS_DIR, name)
-            if not os.path.isdir(task_dir):
-                continue
-            meta = read_meta(task_dir)
-            if not meta:
-                continue
-            status = meta.get('status')
-            # Consider tasks that are completed or explicitly ready for deploy
-            if status not in ('completed', 'ready_for_deploy'):
-                continue
-            # Check task spec for deploy flag
-            spec_path = os.path.join(task_dir, 'spec.yaml')
-            deploy_flag = False
-            spec = {}
-            if os.path.exists(spec_path):
-                try:
-                    with open(spec_path) as f:
-                        spec = yaml.safe_load(f) or {}
-                        deploy_flag = bool(spec.get('deploy', False))
-                except Exception as e:
-                    print('Failed to read spec for', name, e)
-                    deploy_flag = False
-            if not deploy_flag:
-                # Skip tasks that are not marked for deployment
-                continue
-            src_dir = os.path.join(task_dir, 'src')
-            if not os.path.exists(src_dir):
-                continue
-            # Prepare per-task deploy directories
-            task_deploy_dir = os.path.join(DEPLOY_DIR, name)
-            os.makedirs(task_deploy_dir, exist_ok=True)
-            revisions_dir = os.path.join(task_deploy_dir, 'revisions')
-            os.makedirs(revisions_dir, exist_ok=True)
-            current_dir = os.path.join(task_deploy_dir, 'current_tmp')
-            if os.path.exists(current_dir):
-                shutil.rmtree(current_dir)
-            shutil.copytree(src_dir, current_dir)
-            final_dir = os.path.join(task_deploy_dir, 'current')
-            # Archive old current
-            if os.path.exists(final_dir):
-                ts = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-                archived = os.path.join(revisions_dir, ts)
-                shutil.move(final_dir, archived)
-            # Atomically move new current into place
-            os.rename(current_dir, final_dir)
-            # Apply per-task/project deployment ownership and mode if provided in spec
-            deployment_cfg = spec.get('deployment') if isinstance(spec, dict) else None
-            if deployment_cfg:
-                try:
-                    run_as = deployment_cfg.get('run_as') or {}
-                    uid = run_as.get('uid')
-                    gid = run_as.get('gid')
-                    chown_paths = deployment_cfg.get('chown_paths') or ['.']
-                    mode = deployment_cfg.get('mode')
-                    # Normalize chown_paths to list
-                    if isinstance(chown_paths, str):
-                        chown_paths = [chown_paths]
-                    if (uid is not None or gid is not None):
-                        for rel in chown_paths:
-                            target = os.path.join(final_dir, rel)
-                            if not os.path.exists(target):
-                                continue
-                            for root, dirs, files in os.walk(target):
-                                try:
-                                    st = os.stat(root)
-                                    cu = uid if uid is not None else st.st_uid
-                                    cg = gid if gid is not None else st.st_gid
-                                    os.chown(root, cu, cg)
-                                except Exception as e:
-                                    print('chown failed on', root, e)
-                                for d in dirs:
-                                    p = os.path.join(root, d)
-                                    try:
-                                        os.chown(p, cu, cg)
-                                    except Exception as e:
-                                        print('chown failed on', p, e)
-                                for f in files:
-                                    p = os.path.join(root, f)
-                                    try:
-                                        os.chown(p, cu, cg)
-                                    except Exception as e:
-                                        print('chown failed on', p, e)
-                    if mode:
+        spec = read_spec(task_dir)
+        deploy_flag = bool(spec.get('deploy', False))
+    except Exception as e:
+        print('Failed to read spec for', name, e)
+        deploy_flag = False
+    if not deploy_flag:
+        # Skip tasks that are not marked for deployment
+        return
+    src_dir = os.path.join(task_dir, 'src')
+    if not os.path.exists(src_dir):
+        return
+    # Prepare per-task deploy directories
+    task_deploy_dir = os.path.join(DEPLOY_DIR, name)
+    os.makedirs(task_deploy_dir, exist_ok=True)
+    revisions_dir = os.path.join(task_deploy_dir, 'revisions')
+    os.makedirs(revisions_dir, exist_ok=True)
+    # Each deploy is snapshotted once into revisions/<ts>; `current` is a relative symlink that
+    # is swapped atomically, so it never disappears mid-deploy and rollback is just a re-point.
+    ts = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    rev_name = ts
+    n = 1
+    while os.path.exists(os.path.join(revisions_dir, rev_name)):
+        rev_name = f"{ts}-{n}"
+        n += 1
+    shutil.copytree(src_dir, os.path.join(revisions_dir, rev_name), copy_function=_reflink_copy)
+    final_dir = os.path.join(task_deploy_dir, 'current')
+    if os.path.isdir(final_dir) and not os.path.islink(final_dir):
+        # `current` left as a plain directory by an older agent: keep it as a revision
+        os.rename(final_dir, os.path.join(revisions_dir, rev_name + '_legacy'))
+    swap_symlink(os.path.join('revisions', rev_name), final_dir)
+    # Apply per-task/project deployment ownership and mode if provided in spec
+    deployment_cfg = spec.get('deployment') if isinstance(spec, dict) else None
+    if deployment_cfg:
+        try:
+            run_as = deployment_cfg.get('run_as') or {}
+            uid = run_as.get('uid')
+            gid = run_as.get('gid')
+            chown_paths = deployment_cfg.get('chown_paths') or ['.']
+            mode = deployment_cfg.get('mode')
+            # Normalize chown_paths to list
+            if isinstance(chown_paths, str):
+                chown_paths = [chown_paths]
+            if (uid is not None or gid is not None):
+                for rel in chown_paths:
+                    target = os.path.join(final_dir, rel)
+                    if not os.path.exists(target):
+                        continue
+                    for root, dirs, files in os.walk(target):
                         try:
-                            m = int(mode, 8) if isinstance(mode, str) else int(mode)
-                            for rel in chown_paths:
-                                target = os.path.join(final_dir, rel)
-                                if not os.path.exists(target):
-                                    continue
-                                for root, dirs, files in os.walk(target):
-                                    try:
-                                        os.chmod(root, m)
-                                    except Exception as e:
-                                        print('chmod failed on', root, e)
-                                    for d in dirs:
-                                        try:
-                                            os.chmod(os.path.join(root, d), m)
-                                        except Exception as e:
-                                            print('chmod failed on', os.path.join(root, d), e)
-                                    for f in files:
-                                        try:
-                                            os.chmod(os.path.join(root, f), m)
-                                        except Exception as e:
-                                            print('chmod failed on', os.path.join(root, f), e)
+                            st = os.stat(root)
+                            cu = uid if uid is not None else st.st_uid
+                            cg = gid if gid is not None else st.st_gid
+                            os.chown(root, cu, cg)
                         except Exception as e:
-                            print('Failed to apply mode', e)
-                except Exception as e:
-                    print('Failed to apply deployment ownership/mode', e)
-
-            # Decide runner and optionally copy deployed files to a remote host or local www (fallback served dir)
-            runner = 'local'
-            if runner_utils:
-                try:
-                    runner = runner_utils.select_runner('deploy')
-                except Exception:
-                    runner = 'local'
-
-            remote_deploy_path = None
-            if runner == 'remote-ssh':
-                host = os.environ.get('EXTERNAL_DEPLOY_HOST') or os.environ.get('REMOTE_TEST_HOST')
-                user = os.environ.get('EXTERNAL_DEPLOY_USER') or os.environ.get('REMOTE_TEST_USER')
-                port = os.environ.get('EXTERNAL_DEPLOY_SSH_PORT') or os.environ.get('REMOTE_TEST_SSH_PORT')
-                key = os.environ.get('EXTERNAL_DEPLOY_SSH_KEY') or os.environ.get('REMOTE_TEST_SSH_KEY')
-                remote_base = os.environ.get('EXTERNAL_DEPLOY_REMOTE_PATH', '/tmp/devsys/deploy')
-                remote_path = f"{remote_base}/{name}"
+                            print('chown failed on', root, e)
+                        for d in dirs:
+                            p = os.path.join(root, d)
+                            try:
+                                os.chown(p, cu, cg)
+                            except Exception as e:
+                                print('chown failed on', p, e)
+                        for f in files:
+                            p = os.path.join(root, f)
+                            try:
+                                os.chown(p, cu, cg)
+                            except Exception as e:
+                                print('chown failed on', p, e)
+            if mode:
                 try:
-                    if not host or not user:
-                        raise RuntimeError('remote deploy host/user not configured')
-                    ok = False
-                    known_hosts = os.environ.get('EXTERNAL_DEPLOY_KNOWN_HOSTS')
-                    if runner_utils:
-                        # Use helper that copies the whole task directory including secrets and compose overrides
-                        try:
-                            ok = runner_utils.remote_copy_with_secrets_and_compose(task_dir, remote_path, host, user, port=port, key_path=key, known_hosts=known_hosts)
-                        except Exception as e:
-                            print('remote_copy_with_secrets_and_compose failed', e)
-                            ok = False
-                    if ok:
-                        remote_deploy_path = f"{user}@{host}:{remote_path}"
-                        print('Deployed task', name, 'to remote', remote_deploy_path)
-                        # Optionally run docker compose on remote host if requested
-                        run_compose = os.environ.get('EXTERNAL_DEPLOY_RUN_COMPOSE', '').lower() == 'true'
-                        if run_compose:
+                    m = int(mode, 8) if isinstance(mode, str) else int(mode)
+                    for rel in chown_paths:
+                        target = os.path.join(final_dir, rel)
+                        if not os.path.exists(target):
+                            continue
+                        for root, dirs, files in os.walk(target):
                             try:
-                                # If a compose_override file was copied, use it; otherwise fall back to default compose
-                                compose_cmd = "if [ -f compose_override.yml ]; then docker compose -f compose_override.yml up -d --build; else docker compose up -d --build; fi"
-                                ret, out = runner_utils.remote_run(compose_cmd, host, user, port=port, key_path=key, known_hosts=known_hosts, cwd=remote_path, timeout=600)
-                                print('Remote compose result:', ret)
-                                remote_compose_result = {'rc': ret, 'output': out}
+                                os.chmod(root, m)
                             except Exception as e:
-                                print('Remote compose failed', e)
-                                remote_compose_result = {'error': str(e)}
-                        else:
-                            remote_compose_result = None
-                    else:
-                        print('Remote copy failed, falling back to local www copy')
-                        runner = 'local'
+                                print('chmod failed on', root, e)
+                            for d in dirs:
+                                try:
+                                    os.chmod(os.path.join(root, d), m)
+                                except Exception as e:
+                                    print('chmod failed on', os.path.join(root, d), e)
+                            for f in files:
+                                try:
+                                    os.chmod(os.path.join(root, f), m)
+                                except Exception as e:
+                                    print('chmod failed on', os.path.join(root, f), e)
                 except Exception as e:
-                    print('Remote deploy error', e)
-                    runner = 'local'
+                    print('Failed to apply mode', e)
+        except Exception as e:
+            print('Failed to apply deployment ownership/mode', e)
 
-            if runner != 'remote-ssh':
-                try:
-                    www_root = os.path.join(WORKSPACE, 'www')
-                    if os.path.exists(www_root):
-                        # clear www root
-                        for entry in os.listdir(www_root):
-                            full = os.path.join(www_root, entry)
-                            if os.path.isdir(full):
-                                shutil.rmtree(full)
-                            else:
-                                os.remove(full)
-                    else:
-                        os.makedirs(www_root, exist_ok=True)
-                    # copy files
-                    for item in os.listdir(final_dir):
-                        s = os.path.join(final_dir, item)
-                        d = os.path.join(www_root, item)
-                        if os.path.isdir(s):
-                            shutil.copytree(s, d)
-                        else:
-                            shutil.copy2(s, d)
-                except Exception as e:
-                    print('Failed to copy to www root', e)
-
-            # Record deployment
-            record = {
-                'task': name,
-                'timestamp': datetime.utcnow().isoformat() + 'Z',
-                'path': remote_deploy_path if remote_deploy_path else final_dir
-            }
-            # attach remote compose result if present
-            try:
-                if 'remote_compose_result' in locals() and remote_compose_result is not None:
-                    record['remote_compose'] = remote_compose_result
-            except Exception:
-                pass
-            write_deploy_record(task_dir, record)
-            # Update task status to deployed
+    # Decide runner and optionally copy deployed files to a remote host or local www (fallback served dir)
+    runner = 'local'
+    if runner_utils:
+        try:
+            runner = runner_utils.select_runner('deploy')
+        except Exception:
+            runner = 'local'
+
+    remote_deploy_path = None
+    if runner == 'remote-ssh':
+        host, user, port, key = _remote_deploy_target()
+        remote_base = os.environ.get('EXTERNAL_DEPLOY_REMOTE_PATH', '/tmp/devsys/deploy')
+        remote_path = f"{remote_base}/{name}"
+        try:
+            if not host or not user:
+                raise RuntimeError('remote deploy host/user not configured')
+            ok = False
+            known_hosts = os.environ.get('EXTERNAL_DEPLOY_KNOWN_HOSTS')
+            if runner_utils:
+                # Use helper that copies the whole task directory including secrets and compose overrides
                 try:
-                    requests.post(f"{MANAGER_URL}/api/tasks/{name}/status", json={'status': 'deployed'}, timeout=5, headers=HEADERS)
+                    ok = runner_utils.remote_copy_with_secrets_and_compose(task_dir, remote_path, host, user, port=port, key_path=key, known_hosts=known_hosts)
                 except Exception as e:
-                    print('Failed to update manager status', e)
-
-            print('Deployed task', name, 'to', final_dir)
-            # Perform acceptance check
-            ok, info = check_acceptance(task_dir, spec)
-            record['acceptance'] = info
-            record['verified'] = ok
-            write_deploy_record(task_dir, record)
+                    print('remote_copy_with_secrets_and_compose failed', e)
+                    ok = False
             if ok:
-                try:
-                    requests.post(f"{MANAGER_URL}/api/tasks/{name}/status", json={'status': 'verified'}, timeout=5, headers=HEADERS)
-                except Exception as e:
-                    print('Failed to update manager status to verified', e)
+                remote_deploy_path = f"{user}@{host}:{remote_path}"
+                print('Deployed task', name, 'to remote', remote_deploy_path)
+                # Optionally run docker compose on remote host if requested
+                run_compose = os.environ.get('EXTERNAL_DEPLOY_RUN_COMPOSE', '').lower() == 'true'
+                if run_compose:
+                    try:
+                        # If a compose_override file was copied, use it; otherwise fall back to default compose
+                        compose_cmd = "if [ -f compose_override.yml ]; then docker compose -f compose_override.yml up -d --build; else docker compose up -d --build; fi"
+                        ret, out = runner_utils.remote_run(compose_cmd, host, user, port=port, key_path=key, known_hosts=known_hosts, cwd=remote_path, timeout=600)
+                        print('Remote compose result:', ret)
+                        remote_compose_result = {'rc': ret, 'output': out}
+                    except Exception as e:
+                        print('Remote compose failed', e)
+                        remote_compose_result = {'error': str(e)}
+                else:
+                    remote_compose_result = None
             else:
-                try:
-                    requests.post(f"{MANAGER_URL}/api/tasks/{name}/status", json={'status': 'failed'}, timeout=5, headers=HEADERS)
-                except Exception as e:
-                    print('Failed to update manager status to failed', e)
-                # Create follow-up task to fix deployment
-                create_followup_task(name, f"Acceptance checks failed: {info}")
+                print('Remote copy failed, falling back to local www copy')
+                runner = 'local'
+        except Exception as e:
+            print('Remote deploy error', e)
+            runner = 'local'
 
+    if runner != 'remote-ssh':
+        # The www root is shared by all tasks; publish one deployment at a time
+        with _www_lock:
+            try:
+                www_root = os.path.join(WORKSPACE, 'www')
+                if os.path.exists(www_root):
+                    # clear www root
+                    for entry in os.listdir(www_root):
+                        full = os.path.join(www_root, entry)
+                        if os.path.isdir(full):
+                            shutil.rmtree(full)
+                        else:
+                            os.remove(full)
+                # publish the whole tree in one pass
+                shutil.copytree(final_dir, www_root, dirs_exist_ok=True, copy_function=_link_or_copy)
+            except Exception as e:
+                print('Failed to copy to www root', e)
+
+    # Record deployment
+    record = {
+        'task': name,
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'path': remote_deploy_path if remote_deploy_path else final_dir
+    }
+    # attach remote compose result if present
+    try:
+        if 'remote_compose_result' in locals() and remote_compose_result is not None:
+            record['remote_compose'] = remote_compose_result
+    except Exception:
+        pass
+    # Update task status to deployed
+    try:
+        session.post(f"{MANAGER_URL}/api/tasks/{name}/status", json={'status': 'deployed'}, timeout=5, headers=HEADERS)
     except Exception as e:
-        print('Deployment worker error', e)
-    time.sleep(5)
+        print('Failed to update manager status', e)
+
+    print('Deployed task', name, 'to', final_dir)
+    # Perform acceptance check
+    ok, info = check_acceptance(task_dir, spec)
+    record['acceptance'] = info
+    record['verified'] = ok
+    # One history entry per deploy, written once the acceptance outcome is known
+    write_deploy_record(task_dir, record)
+    if ok:
+        try:
+            session.post(f"{MANAGER_URL}/api/tasks/{name}/status", json={'status': 'verified'}, timeout=5, headers=HEADERS)
+        except Exception as e:
+            print('Failed to update manager status to verified', e)
+    else:
+        try:
+            session.post(f"{MANAGER_URL}/api/tasks/{name}/status", json={'status': 'failed'}, timeout=5, headers=HEADERS)
+        except Exception as e:
+            print('Failed to update manager status to failed', e)
+        # Create follow-up task to fix deployment
+        create_followup_task(name, f"Acceptance checks failed: {info}")
+
+
+def handle_tasks(executor, task_dirs):
+    """Run handle_task for each task dir on the pool and wait for the batch to finish,
+    so the same task is never handled by two threads at once."""
+    futures = {executor.submit(handle_task, task_dir): task_dir for task_dir in task_dirs}
+    for fut in as_completed(futures):
+        try:
+            fut.result()
+        except Exception as e:
+            print('Deployment worker error for', os.path.basename(futures[fut]), e)
+
+
+def sweep(executor):
+    """Check every task directory; used at startup and as periodic housekeeping."""
+    with os.scandir(TASKS_DIR) as it:
+        task_dirs = [entry.path for entry in it if entry.is_dir(follow_symlinks=False)]
+    handle_tasks(executor, task_dirs)
+
+
+def _pending_mtime():
+    try:
+        return os.stat(DEPLOY_PENDING_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _remote_deploy_target():
+    """(host, user, port, key) for remote-ssh deploys; the REMOTE_TEST_* settings are the fallback."""
+    return (os.environ.get('EXTERNAL_DEPLOY_HOST') or os.environ.get('REMOTE_TEST_HOST'),
+            os.environ.get('EXTERNAL_DEPLOY_USER') or os.environ.get('REMOTE_TEST_USER'),
+            os.environ.get('EXTERNAL_DEPLOY_SSH_PORT') or os.environ.get('REMOTE_TEST_SSH_PORT'),
+            os.environ.get('EXTERNAL_DEPLOY_SSH_KEY') or os.environ.get('REMOTE_TEST_SSH_KEY'))
+
+
+def main():
+    print('Deployment agent started. Deploy dir:', DEPLOY_DIR, 'concurrency=', CONCURRENCY)
+    os.makedirs(TASKS_DIR, exist_ok=True)
+    if runner_utils and runner_utils.select_runner('deploy') == 'remote-ssh':
+        host, user, port, key = _remote_deploy_target()
+        # no-op unless REMOTE_SSH_PREWARM=true
+        runner_utils.warm_hosts([{'host': host, 'user': user, 'port': port, 'key_path': key,
+                                  'known_hosts': os.environ.get('EXTERNAL_DEPLOY_KNOWN_HOSTS')}])
+    executor = ThreadPoolExecutor(max_workers=CONCURRENCY)
+    if watch is None:
+        print('watchfiles not available; polling every 5 seconds')
+        sweep(executor)
+        last_sweep = time.monotonic()
+        last_pending = _pending_mtime()
+        while True:
+            time.sleep(5)
+            # While idle each poll is one stat of the marker; housekeeping still sweeps
+            # periodically for tasks whose status changed without going through the manager.
+            pending = _pending_mtime()
+            if pending == last_pending and time.monotonic() - last_sweep < HOUSEKEEPING_INTERVAL:
+                continue
+            last_pending = pending
+            sweep(executor)
+            last_sweep = time.monotonic()
+    # React to meta.json writes as they happen. The watcher is registered before the first
+    # yield, so the startup sweep runs then and cannot miss a write made during it; a slow
+    # housekeeping sweep then recovers from any missed events every HOUSEKEEPING_INTERVAL.
+    last_sweep = None
+    for changes in watch(TASKS_DIR, recursive=True, force_polling=FORCE_POLLING,
+                         rust_timeout=WATCH_TICK_MS, yield_on_timeout=True):
+        if last_sweep is None or time.monotonic() - last_sweep >= HOUSEKEEPING_INTERVAL:
+            last_sweep = time.monotonic()
+            sweep(executor)
+            continue
+        task_dirs = {os.path.dirname(path) for _, path in changes if os.path.basename(path) == 'meta.json'}
+        handle_tasks(executor, [d for d in task_dirs if os.path.dirname(d) == TASKS_DIR])
+
+
+if __name__ == '__main__':
+    main()
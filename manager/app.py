@@ -1,26 +1,62 @@
 import os
+import sys
 import json
 import uuid
-from flask import Flask, request, jsonify
-from datetime import datetime
-import yaml
-import jsonschema
-import shutil
+import re
+import reprlib
+import threading
+from flask import Flask, Response, request, jsonify, stream_with_context, abort, make_response
+# allow importing utils from repository root (the container copies it next to app.py)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.fs import swap_symlink
+from datetime import datetime, timezone
+# yaml and jsonschema are imported where they are used (task creation, validator fallback)
+# so read-only workers and test collection don't pay for them at startup
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
-WORKSPACE = os.environ.get('WORKSPACE', '/workspace')
-TASKS_DIR = os.path.join(WORKSPACE, 'tasks')
+
+if orjson is not None:
+    from flask.json.provider import DefaultJSONProvider
+
+    class _OrjsonProvider(DefaultJSONProvider):
+        """Route jsonify() and request.get_json() through orjson: bytes straight into the
+        response body, no JSONEncoder pass. Keys are not sorted."""
+        _options = orjson.OPT_NON_STR_KEYS
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default, option=self._options).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            body = orjson.dumps(obj, default=self.default, option=self._options)
+            return self._app.response_class(body, mimetype=self.mimetype)
+
+    app.json = _OrjsonProvider(app)
 SCHEMA_PATH = os.path.join(os.path.dirname(__file__), 'task_schema.json')
 PROJECT_SCHEMA_PATH = os.path.join(os.path.dirname(__file__), '..', 'specs', 'project.schema.json')
 # Manager API token for simple auth (optional). If set, requests must provide this token.
-MANAGER_API_TOKEN = os.environ.get('MANAGER_API_TOKEN')
+# Read from app.config at request time so it can be changed without re-importing the app.
+app.config['API_TOKEN'] = os.environ.get('MANAGER_API_TOKEN')
 from functools import wraps
 from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
 
 def auth_required(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        if not MANAGER_API_TOKEN:
+        expected = app.config.get('API_TOKEN')
+        if not expected:
             return func(*args, **kwargs)
         # Accept Authorization: Bearer <token> or X-Api-Token header
         auth = request.headers.get('Authorization', '')
@@ -29,7 +65,7 @@ def auth_required(func):
             token = auth.split(' ', 1)[1].strip()
         if not token:
             token = request.headers.get('X-Api-Token')
-        if token != MANAGER_API_TOKEN:
+        if token != expected:
             return jsonify({'error': 'unauthorized'}), 401
         return func(*args, **kwargs)
     return wrapper
@@ -37,41 +73,195 @@ def auth_required(func):
 # Load schemas
 def _load_json(path):
     try:
-        with open(path) as f:
-            return json.load(f)
+        return _read_json(path)
     except Exception:
         return None
 
+def _read_json(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _dumps(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def _write_json(path, obj):
+    # Write beside the target and rename over it, so readers never see a truncated file.
+    # The temp name is per process and thread since several workers may write the same file.
+    data = _dumps(obj)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _write_env_file(path, env):
+    """Write KEY=value lines in one buffer to a fresh 0600 file renamed over `path`, so the
+    file is never readable with wider perms nor seen half-written."""
+    data = ''.join(f"{k}={v}\n" for k, v in env.items()).encode()
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+
+
+def _yaml_dump(obj, stream):
+    import yaml
+    try:
+        from yaml import CSafeDumper as Dumper
+    except ImportError:
+        from yaml import SafeDumper as Dumper
+    yaml.dump(obj, stream, Dumper=Dumper)
+
+
+def _now_iso():
+    # same shape as utcnow().isoformat() + 'Z' in one format call, without the naive utcnow()
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _json_response(obj, status=200):
+    return jsonify(obj), status
+
+
+def _file_etag(*paths):
+    """ETag for a response built from `paths`, taken from their stat alone (mtime_ns and size).
+    Missing files are skipped; returns None if none exist. No Last-Modified is derived from it:
+    HTTP dates have one-second resolution, so If-Modified-Since would answer 304 for a change made
+    in the same second."""
+    parts = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        parts.append(f'{st.st_mtime_ns:x}-{st.st_size:x}')
+    if not parts:
+        return None
+    return '.'.join(parts)
+
+
+def _not_modified(etag):
+    # Checked before building the body, so a polling client with a fresh copy costs a stat or two
+    if is_resource_modified(request.environ, etag=etag):
+        return None
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    return resp
+
+
+def _with_etag(resp, etag):
+    resp = app.make_response(resp)
+    resp.set_etag(etag)
+    return resp
+
+
 TASK_SCHEMA = _load_json(SCHEMA_PATH)
 PROJECT_SCHEMA = _load_json(PROJECT_SCHEMA_PATH)
 
-os.makedirs(TASKS_DIR, exist_ok=True)
+
+def _build_validator(schema):
+    """Compile a schema once; returns a callable giving the first validation error for an
+    instance, or None if it is valid."""
+    if not schema:
+        return None
+    if fastjsonschema is not None:
+        # Generated straight-line code instead of walking the schema per call. Formats are
+        # not asserted, matching jsonschema's default behaviour.
+        validate = fastjsonschema.compile(schema, use_formats=False)
+
+        def first_error(instance):
+            try:
+                validate(instance)
+            except fastjsonschema.JsonSchemaException as e:
+                # include the offending value (bounded) as jsonschema's messages do
+                return f"{e.message} (got {reprlib.repr(e.value)})"
+            return None
+        return first_error
+    import jsonschema
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    validator = cls(schema)
+    # Same error selection as jsonschema.validate(), without rebuilding the validator
+    return lambda instance: jsonschema.exceptions.best_match(validator.iter_errors(instance))
+
+
+TASK_VALIDATOR = _build_validator(TASK_SCHEMA)
+PROJECT_VALIDATOR = _build_validator(PROJECT_SCHEMA)
+
+
+def configure_workspace(path):
+    """Point the manager at a workspace root. Runs once at import from $WORKSPACE; tests call it
+    to give a shared app instance a fresh workspace instead of re-importing the module."""
+    global WORKSPACE, TASKS_DIR, _TASKS_DIR_PREFIX, _DEPLOY_DIR_PREFIX, DEPLOY_PENDING_FILE
+    WORKSPACE = path
+    TASKS_DIR = os.path.join(WORKSPACE, 'tasks')
+    _TASKS_DIR_PREFIX = TASKS_DIR + os.sep
+    _DEPLOY_DIR_PREFIX = os.path.join(WORKSPACE, 'deploy') + os.sep
+    DEPLOY_PENDING_FILE = os.path.join(WORKSPACE, '.deploy_pending')
+    os.makedirs(TASKS_DIR, exist_ok=True)
+
+configure_workspace(os.environ.get('WORKSPACE', '/workspace'))
+
+# Declared secret names become file names under secrets/: a single component, no leading dot
+_SECRET_NAME_RE = re.compile(r'[A-Za-z0-9_-][A-Za-z0-9._-]*')
+
+
+def _valid_task_id(task_id):
+    # a task id must be one path component so it can never escape TASKS_DIR; anything else
+    # (spaces, unicode, dots inside the name) is a legitimate id
+    return (isinstance(task_id, str) and task_id not in ('', '.', '..')
+            and '/' not in task_id and '\0' not in task_id)
+
+
+def _invalid_task_id():
+    return jsonify({'error': 'invalid task id'}), 400
+
 
 def task_path(task_id):
-    return os.path.join(TASKS_DIR, task_id)
+    if not _valid_task_id(task_id):
+        abort(make_response(_invalid_task_id()))
+    return _TASKS_DIR_PREFIX + task_id
+
+
+def deploy_root_for(task_id):
+    if not _valid_task_id(task_id):
+        abort(make_response(_invalid_task_id()))
+    return _DEPLOY_DIR_PREFIX + task_id
 
 @app.route('/api/tasks', methods=['POST'])
 @auth_required
 def create_task():
     data = request.get_json() or {}
     task_id = data.get('id') or f"task-{uuid.uuid4().hex[:8]}"
+    if not _valid_task_id(task_id):
+        return _invalid_task_id()
     title = data.get('title', 'untitled')
     spec = data.get('spec') or data
 
-    # If the spec looks like a full project manifest and a project schema exists, validate and convert it
+    # If the spec is a full project manifest and a project schema exists, validate and convert it.
+    # schemaVersion is required by the project schema, so its absence rules a manifest out
+    # without a validator pass (and a plain task that happens to have a `name` is not rejected).
     is_project_manifest = False
-    if PROJECT_SCHEMA and any(k in spec for k in ('schemaVersion', 'name', 'slug')):
-        try:
-            jsonschema.validate(instance=spec, schema=PROJECT_SCHEMA)
-            is_project_manifest = True
-        except jsonschema.ValidationError as e:
-            return jsonify({'error': 'project manifest validation failed', 'message': str(e)}), 400
+    if PROJECT_VALIDATOR and 'schemaVersion' in spec:
+        error = PROJECT_VALIDATOR(spec)
+        if error is not None:
+            return jsonify({'error': 'project manifest validation failed', 'message': str(error)}), 400
+        is_project_manifest = True
 
     if is_project_manifest:
         proj = spec
         # Prefer slug from project manifest as task id if available
         if proj.get('slug'):
             task_id = proj.get('slug')
+            if not _valid_task_id(task_id):
+                return _invalid_task_id()
         # Convert project manifest to a task spec for deployment by default
         spec = {
             'id': task_id,
@@ -88,11 +278,10 @@ def create_task():
 
 
     # Validate spec against the task schema if available
-    if TASK_SCHEMA:
-        try:
-            jsonschema.validate(instance=spec, schema=TASK_SCHEMA)
-        except jsonschema.ValidationError as e:
-            return jsonify({'error': 'spec validation failed', 'message': str(e)}), 400
+    if TASK_VALIDATOR:
+        error = TASK_VALIDATOR(spec)
+        if error is not None:
+            return jsonify({'error': 'spec validation failed', 'message': str(error)}), 400
 
     task_dir = task_path(task_id)
     os.makedirs(task_dir, exist_ok=True)
@@ -101,10 +290,12 @@ def create_task():
         'id': task_id,
         'title': title,
         'status': 'created',
-        'created_at': datetime.utcnow().isoformat() + 'Z'
+        'created_at': _now_iso()
     }
     with open(spec_path, 'w') as f:
-        yaml.safe_dump(spec, f)
+        _yaml_dump(spec, f)
+    # JSON sidecar lets agents skip YAML parsing; written after spec.yaml so its mtime is newer
+    _write_json(os.path.join(task_dir, 'spec.cache.json'), spec)
 
     # If deployment env/secrets are present, persist them under workspace/tasks/<id>/secrets
     deployment = spec.get('deployment') if isinstance(spec, dict) else None
@@ -115,32 +306,25 @@ def create_task():
             # Write env vars as .env file
             env = deployment.get('env') or {}
             if env:
-                env_path = os.path.join(secrets_dir, '.env')
-                with open(env_path, 'w') as ef:
-                    for k, v in env.items():
-                        ef.write(f"{k}={v}\n")
-                try:
-                    os.chmod(env_path, 0o600)
-                except Exception:
-                    pass
+                _write_env_file(os.path.join(secrets_dir, '.env'), env)
             # Create placeholder secret files for declared secrets (manager won't store secret values in manifest)
             declared = deployment.get('secrets') or []
             for name in declared:
+                if not isinstance(name, str) or not _SECRET_NAME_RE.fullmatch(name):
+                    print('Skipping invalid secret name for task', task_id, repr(name))
+                    continue
                 p = os.path.join(secrets_dir, name)
-                if not os.path.exists(p):
-                    open(p, 'w').close()
-                    try:
-                        os.chmod(p, 0o600)
-                    except Exception:
-                        pass
+                try:
+                    os.close(os.open(p, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+                except FileExistsError:
+                    pass
             # Update meta to indicate secrets present
             meta['secrets'] = True
         except Exception as e:
             print('Failed to write deployment secrets/env for task', task_id, e)
 
-    with open(os.path.join(task_dir, 'meta.json'), 'w') as f:
-        json.dump(meta, f)
-    return jsonify(meta), 201
+    _write_json(os.path.join(task_dir, 'meta.json'), meta)
+    return _json_response(meta, 201)
 
 @app.route('/api/tasks/<task_id>/secrets', methods=['POST'])
 @auth_required
@@ -158,15 +342,8 @@ def upload_task_secrets(task_id):
         payload = request.get_json() or {}
         env = payload.get('env')
         if isinstance(env, dict):
-            env_path = os.path.join(secrets_dir, '.env')
             try:
-                with open(env_path, 'w') as ef:
-                    for k, v in env.items():
-                        ef.write(f"{k}={v}\n")
-                try:
-                    os.chmod(env_path, 0o600)
-                except Exception:
-                    pass
+                _write_env_file(os.path.join(secrets_dir, '.env'), env)
                 updated_files.append('.env')
             except Exception as e:
                 return jsonify({'error': 'failed to write env file', 'message': str(e)}), 500
@@ -191,15 +368,13 @@ def upload_task_secrets(task_id):
     # Update meta
     meta_file = os.path.join(d, 'meta.json')
     try:
-        if os.path.exists(meta_file):
-            with open(meta_file) as mf:
-                meta = json.load(mf)
-        else:
+        try:
+            meta = _read_json(meta_file)
+        except FileNotFoundError:
             meta = {'id': task_id}
         meta['secrets'] = True
         meta['secret_files'] = sorted(list(set(meta.get('secret_files', []) + updated_files)))
-        with open(meta_file, 'w') as mf:
-            json.dump(meta, mf)
+        _write_json(meta_file, meta)
     except Exception as e:
         return jsonify({'error': 'failed to update meta', 'message': str(e)}), 500
     return jsonify({'result': 'ok', 'files': updated_files}), 201
@@ -219,69 +394,163 @@ def list_task_secrets(task_id):
 
 @app.route('/api/tasks', methods=['GET'])
 def list_tasks():
-    tasks = []
-    for name in os.listdir(TASKS_DIR):
-        d = task_path(name)
-        meta_file = os.path.join(d, 'meta.json')
-        if os.path.exists(meta_file):
-            with open(meta_file) as f:
-                tasks.append(json.load(f))
-    return jsonify(tasks)
+    # Stream the JSON array one task at a time, re-emitting each meta.json verbatim
+    # instead of parsing everything into memory and reserializing it.
+    def generate():
+        yield b'['
+        first = True
+        with os.scandir(TASKS_DIR) as it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    with open(os.path.join(entry.path, 'meta.json'), 'rb') as f:
+                        raw = f.read().strip()
+                except FileNotFoundError:
+                    continue
+                if not raw:
+                    continue
+                if not first:
+                    yield b','
+                first = False
+                yield raw
+        yield b']'
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 @app.route('/api/tasks/<task_id>', methods=['GET'])
 def get_task(task_id):
     d = task_path(task_id)
     meta_file = os.path.join(d, 'meta.json')
-    if not os.path.exists(meta_file):
+    etag = _file_etag(meta_file)
+    if etag is None:
         return jsonify({'error': 'not found'}), 404
-    with open(meta_file) as f:
-        return jsonify(json.load(f))
+    cached = _not_modified(etag)
+    if cached is not None:
+        return cached
+    return _with_etag(_json_response(_read_json(meta_file)), etag)
+
+# Statuses the deployment agent acts on; entering one bumps the .deploy_pending marker
+DEPLOYABLE_STATUSES = ('completed', 'ready_for_deploy')
+
+
+def _mark_deploy_pending():
+    """Bump the marker mtime so the deployment agent's idle poll is a single stat."""
+    try:
+        os.close(os.open(DEPLOY_PENDING_FILE, os.O_WRONLY | os.O_CREAT, 0o644))
+        os.utime(DEPLOY_PENDING_FILE)
+    except OSError as e:
+        print('Failed to touch', DEPLOY_PENDING_FILE, e)
+
+
+def _set_status(task_id, status):
+    """Persist a new status for a task. Returns the updated meta or None if the task is unknown."""
+    d = task_path(task_id)
+    meta_file = os.path.join(d, 'meta.json')
+    try:
+        meta = _read_json(meta_file)
+    except FileNotFoundError:
+        return None
+    meta['status'] = status
+    meta['updated_at'] = _now_iso()
+    _write_json(meta_file, meta)
+    if status in DEPLOYABLE_STATUSES:
+        _mark_deploy_pending()
+    return meta
+
 
 @app.route('/api/tasks/<task_id>/status', methods=['POST'])
 @auth_required
 def update_status(task_id):
-    d = task_path(task_id)
-    meta_file = os.path.join(d, 'meta.json')
-    if not os.path.exists(meta_file):
-        return jsonify({'error': 'not found'}), 404
     payload = request.get_json() or {}
     status = payload.get('status')
     if not status:
         return jsonify({'error': 'missing status'}), 400
-    with open(meta_file) as f:
-        meta = json.load(f)
-    meta['status'] = status
-    meta['updated_at'] = datetime.utcnow().isoformat() + 'Z'
-    with open(meta_file, 'w') as f:
-        json.dump(meta, f)
-    return jsonify(meta)
+    meta = _set_status(task_id, status)
+    if meta is None:
+        return jsonify({'error': 'not found'}), 404
+    return _json_response(meta)
+
+
+@app.route('/api/tasks/status_batch', methods=['POST'])
+@auth_required
+def update_status_batch():
+    """Apply several status updates in one request.
+    Body is a JSON list of {"id": ..., "status": ...}; returns a per-item result list."""
+    items = request.get_json()
+    if not isinstance(items, list):
+        return jsonify({'error': 'expected a list of {id, status} objects'}), 400
+    results = []
+    for item in items:
+        task_id = item.get('id') if isinstance(item, dict) else None
+        status = item.get('status') if isinstance(item, dict) else None
+        if not task_id or not status:
+            results.append({'id': task_id, 'error': 'missing id or status'})
+            continue
+        if not _valid_task_id(task_id):
+            results.append({'id': task_id, 'error': 'invalid id'})
+            continue
+        meta = _set_status(task_id, status)
+        if meta is None:
+            results.append({'id': task_id, 'error': 'not found'})
+        else:
+            results.append(meta)
+    return _json_response(results)
 
 
 @app.route('/api/tasks/<task_id>/deploy', methods=['POST'])
 @auth_required
 def trigger_deploy(task_id):
     # Mark a task as ready for deploy (deployment-agent will pick it up)
-    d = task_path(task_id)
-    meta_file = os.path.join(d, 'meta.json')
-    if not os.path.exists(meta_file):
+    meta = _set_status(task_id, 'ready_for_deploy')
+    if meta is None:
         return jsonify({'error': 'not found'}), 404
-    with open(meta_file) as f:
-        meta = json.load(f)
-    meta['status'] = 'ready_for_deploy'
-    meta['updated_at'] = datetime.utcnow().isoformat() + 'Z'
-    with open(meta_file, 'w') as f:
-        json.dump(meta, f)
-    return jsonify(meta)
+    return _json_response(meta)
 
 
 @app.route('/api/tasks/<task_id>/deploys', methods=['GET'])
 def get_deploy_history(task_id):
     d = task_path(task_id)
-    records_file = os.path.join(d, 'deploy_records.json')
-    if not os.path.exists(records_file):
-        return jsonify([])
-    with open(records_file) as f:
-        return jsonify(json.load(f))
+    legacy_file = os.path.join(d, 'deploy_records.json')
+    records_file = os.path.join(d, 'deploy_records.jsonl')
+    etag = _file_etag(legacy_file, records_file)
+    if etag is not None:
+        cached = _not_modified(etag)
+        if cached is not None:
+            return cached
+
+    # History is append-only JSON Lines; stream it out as a JSON array without reparsing.
+    # Tasks deployed before the switch may still have a legacy JSON array file.
+    def generate():
+        yield b'['
+        first = True
+        try:
+            with open(legacy_file, 'rb') as f:
+                legacy = f.read().strip()
+        except FileNotFoundError:
+            legacy = b''
+        # splice the legacy array's elements in verbatim rather than parsing and re-encoding
+        if legacy.startswith(b'[') and legacy.endswith(b']'):
+            inner = legacy[1:-1].strip()
+            if inner:
+                yield inner
+                first = False
+        try:
+            f = open(records_file, 'rb')
+        except FileNotFoundError:
+            f = None
+        if f is not None:
+            with f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    yield (b'' if first else b',') + line
+                    first = False
+        yield b']'
+    resp = Response(stream_with_context(generate()), mimetype='application/json')
+    if etag is not None:
+        resp = _with_etag(resp, etag)
+    return resp
 
 
 @app.route('/api/tasks/<task_id>/tests/latest', methods=['GET'])
@@ -289,78 +558,89 @@ def get_deploy_history(task_id):
 def get_latest_test_report(task_id):
     d = task_path(task_id)
     records_file = os.path.join(d, 'test_records.json')
-    if not os.path.exists(records_file):
+    # Each validator is taken before its file is read and checked again afterwards; if the
+    # testing agent rewrote a file in between, the body goes out without an ETag rather than
+    # pairing old content with the new file's tag.
+    records_etag = _file_etag(records_file)
+    if records_etag is None:
         return jsonify({'error': 'no test records'}), 404
     try:
-        with open(records_file) as f:
-            records = json.load(f)
+        records = _read_json(records_file)
+    except FileNotFoundError:
+        return jsonify({'error': 'no test records'}), 404
     except Exception:
         return jsonify({'error': 'failed to read test records'}), 500
+    if _file_etag(records_file) != records_etag:
+        records_etag = None
     if not records:
         return jsonify({'error': 'no test records'}), 404
     latest = records[-1]
     report_path = latest.get('report')
     if not report_path:
-        return jsonify({'latest': latest})
+        if records_etag is None:
+            return jsonify({'latest': latest})
+        cached = _not_modified(records_etag)
+        return cached if cached is not None else _with_etag(jsonify({'latest': latest}), records_etag)
     # report_path is relative to TASKS_DIR/<task_id>/
     full_report = os.path.join(d, os.path.relpath(report_path, start=task_id))
-    if not os.path.exists(full_report):
-        return jsonify({'latest': latest, 'warning': 'report file not found'}), 200
+    # the body embeds the report, so a rewritten report must change the ETag too
+    report_etag = _file_etag(full_report)
+    etag = f'{records_etag}.{report_etag}' if records_etag and report_etag else None
+    if etag is not None:
+        cached = _not_modified(etag)
+        if cached is not None:
+            return cached
     try:
         with open(full_report) as rf:
             content = rf.read()
+    except FileNotFoundError:
+        return jsonify({'latest': latest, 'warning': 'report file not found'}), 200
     except Exception:
         content = None
-    return jsonify({'latest': latest, 'report_content': content})
+    if etag is not None and _file_etag(full_report) != report_etag:
+        etag = None
+    resp = jsonify({'latest': latest, 'report_content': content})
+    return _with_etag(resp, etag) if etag is not None else resp
 
 
 @app.route('/api/tasks/<task_id>/rollback', methods=['POST'])
 @auth_required
 def rollback_deploy(task_id):
     # Roll back a deployment for a given task to a specified revision timestamp or last revision
+    if not _valid_task_id(task_id):
+        return _invalid_task_id()
     payload = request.get_json() or {}
     revision = payload.get('revision')
-    deploy_root = os.path.join(WORKSPACE, 'deploy', task_id)
+    deploy_root = deploy_root_for(task_id)
     if not os.path.exists(deploy_root):
         return jsonify({'error': 'no deploy history for task'}), 404
     revisions_dir = os.path.join(deploy_root, 'revisions')
     if not os.path.exists(revisions_dir):
         return jsonify({'error': 'no revisions available'}), 404
+    current_dir = os.path.join(deploy_root, 'current')
+    current_rev = os.path.basename(os.readlink(current_dir)) if os.path.islink(current_dir) else None
     # Determine target revision
     if revision:
         target = os.path.join(revisions_dir, revision)
         if not os.path.exists(target):
             return jsonify({'error': 'specified revision not found'}), 404
     else:
-        # pick most recent revision
-        revs = sorted(os.listdir(revisions_dir))
-        if not revs:
+        # pick most recent revision other than the one currently deployed (names are timestamps)
+        with os.scandir(revisions_dir) as it:
+            latest = max((e.name for e in it if e.name != current_rev and e.is_dir()), default=None)
+        if latest is None:
             return jsonify({'error': 'no revisions available'}), 404
-        target = os.path.join(revisions_dir, revs[-1])
-    current_dir = os.path.join(deploy_root, 'current')
-    if os.path.exists(current_dir):
-        # archive current
-        archived = os.path.join(revisions_dir, datetime.utcnow().strftime('%Y%m%dT%H%M%SZ') + '_rollback')
-        shutil.move(current_dir, archived)
-    # restore target
-    restored = os.path.join(deploy_root, 'restored_tmp')
-    if os.path.exists(restored):
-        shutil.rmtree(restored)
-    shutil.copytree(target, restored)
-    if os.path.exists(current_dir):
-        shutil.rmtree(current_dir)
-    os.rename(restored, current_dir)
-    # Update task meta
-    d = task_path(task_id)
-    meta_file = os.path.join(d, 'meta.json')
-    if os.path.exists(meta_file):
-        with open(meta_file) as f:
-            meta = json.load(f)
-        meta['status'] = 'rolled_back'
-        meta['updated_at'] = datetime.utcnow().isoformat() + 'Z'
-        with open(meta_file, 'w') as f:
-            json.dump(meta, f)
+        target = os.path.join(revisions_dir, latest)
+    if os.path.isdir(current_dir) and not os.path.islink(current_dir):
+        # archive a plain-directory current left by an older deployment agent
+        archived = os.path.join(revisions_dir, datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ') + '_rollback')
+        os.rename(current_dir, archived)
+    # Revisions are immutable snapshots, so restoring one is an atomic symlink re-point
+    swap_symlink(os.path.join('revisions', os.path.basename(target)), current_dir)
+    # Update task meta (a no-op for deploys whose task dir is gone)
+    _set_status(task_id, 'rolled_back')
     return jsonify({'result': 'rolled_back', 'restored_from': os.path.basename(target)})
 
 if __name__ == '__main__':
+    # Local development only; the container runs the app under gunicorn (see Dockerfile)
     app.run(host='0.0.0.0', port=8080)
@@ -2,46 +2,80 @@ import os
 import time
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import yaml
-from datetime import datetime
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 WORKSPACE = os.environ.get('WORKSPACE', '/workspace')
 MANAGER_URL = os.environ.get('MANAGER_URL', 'http://manager:8080')
 MANAGER_API_TOKEN = os.environ.get('MANAGER_API_TOKEN')
 CHECKS_FILE = os.environ.get('CHECKS_FILE', '/monitoring/checks.yaml')
 STATE_FILE = os.path.join(WORKSPACE, 'monitoring_state.json')
+# Checks are independent I/O, so each pass runs them concurrently
+CONCURRENCY = int(os.environ.get('MONITORING_CONCURRENCY', '16'))
 
 HEADERS = {}
 if MANAGER_API_TOKEN:
     HEADERS['Authorization'] = f"Bearer {MANAGER_API_TOKEN}"
 
+# Keep-alive connections to checked endpoints and the manager across passes. The manager
+# token is passed per request so it is never sent to the monitored URLs.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+
 print('Monitoring agent starting, workspace=', WORKSPACE, 'manager=', MANAGER_URL, 'checks=', CHECKS_FILE)
 
+# parsed checks keyed on the file's mtime, so an unchanged file is not re-parsed each pass
+_checks_cache = {'mtime': None, 'data': []}
+
+
 # load checks
 def load_checks():
-    if not os.path.exists(CHECKS_FILE):
+    try:
+        mtime = os.stat(CHECKS_FILE).st_mtime_ns
+    except FileNotFoundError:
+        _checks_cache.update(mtime=None, data=[])
         return []
+    if mtime == _checks_cache['mtime']:
+        return _checks_cache['data']
     try:
         with open(CHECKS_FILE) as f:
-            return yaml.safe_load(f) or []
+            data = yaml.load(f, Loader=_SafeLoader) or []
     except Exception as e:
         print('Failed to load checks', e)
         return []
+    _checks_cache.update(mtime=mtime, data=data)
+    return data
 
 # load state
 def load_state():
     if not os.path.exists(STATE_FILE):
         return {}
     try:
-        with open(STATE_FILE) as f:
-            return json.load(f)
+        with open(STATE_FILE, 'rb') as f:
+            data = f.read()
+        return orjson.loads(data) if orjson else json.loads(data)
     except Exception:
         return {}
 
 def save_state(state):
+    # write to a temp file and rename so readers never see a torn file
+    tmp = STATE_FILE + '.tmp'
     try:
-        with open(STATE_FILE, 'w') as f:
-            json.dump(state, f)
+        with open(tmp, 'wb') as f:
+            f.write(orjson.dumps(state) if orjson else json.dumps(state, separators=(',', ':'), ensure_ascii=False).encode())
+        os.replace(tmp, STATE_FILE)
     except Exception as e:
         print('Failed to save state', e)
 
@@ -59,7 +93,7 @@ def create_followup(check, reason):
         }
     }
     try:
-        r = requests.post(f"{MANAGER_URL}/api/tasks", json=payload, headers=HEADERS, timeout=5)
+        r = SESSION.post(f"{MANAGER_URL}/api/tasks", json=payload, headers=HEADERS, timeout=5)
         if r.status_code in (200,201):
             print('Created follow-up task for', check.get('name'))
         else:
@@ -68,47 +102,50 @@ def create_followup(check, reason):
         print('Error creating follow-up task', e)
 
 
+def run_check(check):
+    """Perform one check; returns (ok, info)."""
+    kind = check.get('type', 'http')
+    if kind != 'http':
+        return False, f'unknown check type: {kind}'
+    url = check.get('url')
+    expected = check.get('status', 200)
+    try:
+        r = SESSION.get(url, timeout=5)
+        if r.status_code == expected:
+            return True, None
+        return False, f'status={r.status_code}'
+    except Exception as e:
+        return False, str(e)
+
+
+executor = ThreadPoolExecutor(max_workers=CONCURRENCY)
 while True:
     checks = load_checks()
     state = load_state()
-    for check in checks:
+    dirty = False
+    # a pass takes about as long as the slowest check; results are merged serially below
+    for check, (ok, info) in zip(checks, executor.map(run_check, checks)):
         name = check.get('name')
-        kind = check.get('type', 'http')
-        interval = check.get('interval', 30)
         threshold = check.get('threshold', 2)
         last = state.get(name, {})
-        # perform check
-        ok = False
-        info = None
-        if kind == 'http':
-            url = check.get('url')
-            expected = check.get('status', 200)
-            try:
-                r = requests.get(url, timeout=5)
-                if r.status_code == expected:
-                    ok = True
-                else:
-                    info = f'status={r.status_code}'
-            except Exception as e:
-                info = str(e)
-        else:
-            info = f'unknown check type: {kind}'
         if ok:
             # reset failure count
             if name in state:
                 state.pop(name, None)
+                dirty = True
             print(f'Check OK: {name}')
         else:
             # increment failure counter
             cnt = last.get('failures', 0) + 1
-            state[name] = {'failures': cnt, 'last_failure': datetime.utcnow().isoformat() + 'Z'}
+            state[name] = {'failures': cnt, 'last_failure': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')}
+            dirty = True
             print(f'Check FAILED: {name} (count={cnt}) info={info}')
             if cnt >= threshold:
                 # create follow-up task and reset counter
                 create_followup(check, info)
                 state.pop(name, None)
+    # one write per pass, and none while every check keeps passing
+    if dirty:
         save_state(state)
-        # sleep between checks if specified (non-blocking behavior is simple serial loop)
-        time.sleep(1)
     # main loop pause
     time.sleep(5)
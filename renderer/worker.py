@@ -1,81 +1,274 @@
 #!/usr/bin/env python3
-# Simple renderer worker skeleton: polls workspace/render_jobs for job.json and attempts a render
+# Simple renderer worker skeleton: watches workspace/render_jobs for job.json and attempts a render
 import os
 import time
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import shlex
+import hashlib
 import subprocess
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeout
+try:
+    from watchfiles import watch
+except Exception:
+    watch = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 WORKSPACE = os.environ.get('WORKSPACE','/workspace')
+RENDER_ROOT = os.path.join(WORKSPACE,'render_jobs')
+USERS_ROOT = os.path.join(WORKSPACE,'users')
+CACHE_ROOT = os.path.join(WORKSPACE,'cache')
+# Safety-net sweep interval while waiting for job.json events
+HOUSEKEEPING_INTERVAL = float(os.environ.get('RENDER_HOUSEKEEPING_INTERVAL','10'))
+# watch() wakes at least this often (ms) so the first sweep runs right after the watcher is
+# registered and housekeeping is time-based rather than waiting for an idle gap
+WATCH_TICK_MS = 1000
+# Jobs are dominated by the Ollama round trip and ffmpeg, so several run at once
+CONCURRENCY = int(os.environ.get('RENDER_CONCURRENCY','4'))
+# fsync job.json before the rename; set RENDER_FSYNC=false when durability isn't needed
+FSYNC = os.environ.get('RENDER_FSYNC','true').lower() != 'false'
+# Texts queued within this window (up to BATCH_SIZE) are phoneticized in one Ollama call
+BATCH_WINDOW = float(os.environ.get('RENDER_BATCH_WINDOW_MS','10')) / 1000.0
+BATCH_SIZE = int(os.environ.get('RENDER_BATCH_SIZE','8'))
+# ffmpeg decodes of uncached phoneme snippets run on a pool shared by all jobs
+DECODE_CONCURRENCY = int(os.environ.get('RENDER_DECODE_CONCURRENCY', str(min(8, os.cpu_count() or 1))))
+# Decoded phoneme WAVs live under cache/<user>/<sha256 of source>.wav; this caps the in-memory index
+PCM_CACHE_MAX = int(os.environ.get('RENDER_PCM_CACHE_MAX','256'))
 OLLAMA_URL = os.environ.get('OLLAMA_URL','https://automatically-bedford-horse-solutions.trycloudflare.com/')
 OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL','qwen2.5:7b-instruct-q4_K_M')
 OLLAMA_KEY = os.environ.get('OLLAMA_KEY','dummy_key')
 
-PHONEME_VOCAB = ['AA','AE','AH','AO','EH','ER','IH','IY','OW','UH','S','T','K']
+# One keep-alive session to Ollama (an HTTPS tunnel), shared by the render threads, so calls
+# don't pay a TCP+TLS handshake each
+_SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(10, CONCURRENCY), max_retries=0)
+_SESSION.mount('http://', _adapter)
+_SESSION.mount('https://', _adapter)
+_SESSION.headers.update({'Content-Type': 'application/json'})
+if OLLAMA_KEY:
+    _SESSION.headers['Authorization'] = f"Bearer {OLLAMA_KEY}"
+_GENERATE_URL = OLLAMA_URL + '/api/generate'
+_PROMPT_PREFIX = 'Phoneticize into ARPAbet tokens: '
+
+PHONEME_VOCAB = frozenset({'AA','AE','AH','AO','EH','ER','IH','IY','OW','UH','S','T','K'})
 
 def list_jobs():
-    root = os.path.join(WORKSPACE,'render_jobs')
-    if not os.path.exists(root):
+    # scandir's DirEntry knows the entry type from the directory read, no stat per job
+    try:
+        with os.scandir(RENDER_ROOT) as it:
+            return [e.path for e in it if e.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
         return []
-    return [os.path.join(root,d) for d in os.listdir(root) if os.path.isdir(os.path.join(root,d))]
+
+def _loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def _dumps(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
 
 def read_job(jobdir):
-    p = os.path.join(jobdir,'job.json')
-    if not os.path.exists(p):
+    try:
+        with open(f"{jobdir}/job.json",'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
         return None
-    with open(p,'r') as f:
-        return json.load(f)
+    return _loads(data)
 
 def write_job(jobdir, job):
-    with open(os.path.join(jobdir,'job.json'),'w') as f:
-        json.dump(job,f,indent=2)
+    # compact unless DEVSYS_DEBUG asks for readable job files
+    indent = bool(os.environ.get('DEVSYS_DEBUG'))
+    if orjson:
+        data = orjson.dumps(job, option=orjson.OPT_INDENT_2 if indent else 0)
+    else:
+        data = json.dumps(job, indent=2, ensure_ascii=False).encode() if indent else _dumps(job)
+    # write beside job.json and rename over it so readers never see a partial file
+    path = f"{jobdir}/job.json"
+    tmp = path + '.tmp'
+    with open(tmp,'wb') as f:
+        f.write(data)
+        if FSYNC:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
 
 def call_ollama_phoneticize(text):
     # Simple wrapper to call the Ollama-like endpoint; we expect JSON back {"phonemes": ["AH","T",...]}
     # This is a placeholder; adapt to actual Ollama API shape
     try:
-        payload = {"model": OLLAMA_MODEL, "prompt": f"Phoneticize into ARPAbet tokens: {text}", "max_tokens": 256}
-        headers = {'Content-Type':'application/json'}
-        if OLLAMA_KEY:
-            headers['Authorization'] = f"Bearer {OLLAMA_KEY}"
-        r = requests.post(OLLAMA_URL + '/api/generate', json=payload, headers=headers, timeout=20)
+        # headers (incl. Content-Type: application/json) live on the session; the body goes
+        # out pre-encoded and the reply is decoded straight from the raw bytes
+        r = _SESSION.post(_GENERATE_URL, data=_dumps({"model": OLLAMA_MODEL, "prompt": _PROMPT_PREFIX + text, "max_tokens": 256}), timeout=20)
         if r.status_code == 200:
-            data = r.json()
+            data = _loads(r.content)
             # naive extraction
             out = data.get('result') or data.get('output') or data
             # For PoC assume comma-separated tokens
-            if isinstance(out, str):
-                toks = [t.strip().upper() for t in out.replace(',', ' ').split()]
-                return [t for t in toks if t in PHONEME_VOCAB]
-            elif isinstance(out, dict):
-                return out.get('phonemes', [])
+            return _phoneme_list(out)
     except Exception as e:
         print('Ollama call failed', e)
     return []
 
+def _phoneme_list(out):
+    if isinstance(out, str):
+        toks = out.replace(',', ' ').upper().split()
+    elif isinstance(out, list):
+        toks = [t.strip().upper() for t in out if isinstance(t, str)]
+    elif isinstance(out, dict):
+        return out.get('phonemes', [])
+    else:
+        return []
+    return [t for t in toks if t in PHONEME_VOCAB]
+
+def call_ollama_phoneticize_batch(texts):
+    """Phoneticize several texts in one /api/generate call. Returns one phoneme list per text,
+    or None when the reply can't be matched up item by item."""
+    lines = '\n'.join(f"{i}. {t}" for i, t in enumerate(texts, 1))
+    prompt = ("Phoneticize each numbered line into ARPAbet tokens. Reply with a JSON object "
+              '{"items": [[...], ...]} holding one token list per line, in order.\n' + lines)
+    payload = {"model": OLLAMA_MODEL, "prompt": prompt, "format": "json", "stream": False,
+               "options": {"temperature": 0}}
+    r = _SESSION.post(_GENERATE_URL, data=_dumps(payload), timeout=20 + 5 * len(texts))
+    if r.status_code != 200:
+        return None
+    data = _loads(r.content)
+    out = data.get('response') or data.get('result') or data.get('output')
+    if isinstance(out, str):
+        out = _loads(out)
+    items = out.get('items') if isinstance(out, dict) else out
+    if not isinstance(items, list) or len(items) != len(texts):
+        return None
+    return [_phoneme_list(item) for item in items]
+
+_batch_queue = queue.Queue()
+_batch_thread = None
+_batch_thread_lock = threading.Lock()
+# Longest a caller waits on the batch thread: the collection window plus one full batch call
+# (call_ollama_phoneticize_batch's own timeout). Past that it falls back to a single call.
+BATCH_WAIT = BATCH_WINDOW + 20 + 5 * BATCH_SIZE
+
+def _batch_loop():
+    # Collects (text, future) pairs from the render threads and answers them with one call
+    while True:
+        batch = [_batch_queue.get()]
+        deadline = time.monotonic() + BATCH_WINDOW
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_batch_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # callers that already gave up and fell back have cancelled their future
+        batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not batch:
+            continue
+        results = None
+        if len(batch) > 1:
+            # similar lengths batch better
+            batch.sort(key=lambda item: len(item[0]))
+            try:
+                results = call_ollama_phoneticize_batch([text for text, _ in batch])
+            except Exception as e:
+                print('Batched Ollama call failed', e)
+        # None tells the waiting thread to fall back to its own single call
+        for i, (_, fut) in enumerate(batch):
+            fut.set_result(results[i] if results is not None else None)
+
+def _ensure_batch_loop():
+    # started on first use so importing this module (tests, other entry points) works too
+    global _batch_thread
+    if _batch_thread is None:
+        with _batch_thread_lock:
+            if _batch_thread is None:
+                _batch_thread = threading.Thread(target=_batch_loop, daemon=True, name='phoneticize-batch')
+                _batch_thread.start()
+
+def phoneticize(text):
+    _ensure_batch_loop()
+    fut = Future()
+    _batch_queue.put((text, fut))
+    try:
+        phonemes = fut.result(timeout=BATCH_WAIT)
+    except FutureTimeout:
+        # a stuck batch call must not stall every render thread behind it
+        fut.cancel()
+        phonemes = None
+    if phonemes is None:
+        phonemes = call_ollama_phoneticize(text)
+    return phonemes
+
+# (user, source path) -> (source mtime_ns, size, decoded wav path), least recently used first
+_phoneme_wav_cache = OrderedDict()
+_phoneme_wav_lock = threading.Lock()
+_decode_locks = {}
+
+def _phoneme_wav(user, src):
+    """Return a 22050 Hz mono WAV decoded from a phoneme snippet. Each distinct source is
+    decoded once; the WAV is keyed by the source's content hash so edits are picked up."""
+    st = os.stat(src)
+    key = (user, src)
+    with _phoneme_wav_lock:
+        hit = _phoneme_wav_cache.get(key)
+        if hit and hit[:2] == (st.st_mtime_ns, st.st_size) and os.path.exists(hit[2]):
+            _phoneme_wav_cache.move_to_end(key)
+            return hit[2]
+        decode_lock = _decode_locks.setdefault(key, threading.Lock())
+    # one decode per snippet even when several jobs need it at the same moment
+    with decode_lock:
+        with open(src,'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        wav = f"{CACHE_ROOT}/{user}/{digest}.wav"
+        if not os.path.exists(wav):
+            os.makedirs(os.path.dirname(wav), exist_ok=True)
+            tmp = f"{wav}.{threading.get_ident()}.tmp.wav"
+            subprocess.run(['ffmpeg','-y','-i',src,'-ar','22050','-ac','1',tmp], check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            os.replace(tmp, wav)
+    with _phoneme_wav_lock:
+        _phoneme_wav_cache[key] = (st.st_mtime_ns, st.st_size, wav)
+        _phoneme_wav_cache.move_to_end(key)
+        while len(_phoneme_wav_cache) > PCM_CACHE_MAX:
+            _phoneme_wav_cache.popitem(last=False)
+    return wav
+
+_decode_pool = ThreadPoolExecutor(max_workers=DECODE_CONCURRENCY)
+
 def build_concat_and_render(jobdir, job, phonemes):
     user = job['user']
-    src_dir = os.path.join(WORKSPACE,'users',user,'phonemes')
-    listfile = os.path.join(jobdir,'files.txt')
-    parts = []
-    for p in phonemes:
-        f = os.path.join(src_dir, p + '.webm')
-        if os.path.exists(f):
-            # Convert to wav snippet
-            wav = os.path.join(jobdir, p + '.wav')
-            subprocess.run(['ffmpeg','-y','-i',f,'-ar','22050','-ac','1',wav], check=False)
-            parts.append(wav)
-        else:
+    src_dir = os.path.join(USERS_ROOT,user,'phonemes')
+
+    def _decode(p):
+        f = f"{src_dir}/{p}.webm"
+        if not os.path.exists(f):
             print('missing phoneme', p)
+            return None
+        try:
+            return _phoneme_wav(user, f)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('failed to decode phoneme', p, e)
+            return None
+
+    # each distinct phoneme is resolved once, the decodes run side by side
+    unique = list(dict.fromkeys(phonemes))
+    wavs = dict(zip(unique, _decode_pool.map(_decode, unique)))
+    parts = [wavs[p] for p in phonemes if wavs[p]]
     if not parts:
         return False, 'no parts'
-    concat_txt = os.path.join(jobdir,'concat.txt')
+    concat_txt = f"{jobdir}/concat.txt"
     with open(concat_txt,'w') as cf:
         for p in parts:
             cf.write(f"file '{p}'\n")
-    out_mp3 = os.path.join(jobdir,'output.mp3')
-    # Use ffmpeg concat demuxer
+    out_mp3 = f"{jobdir}/output.mp3"
+    # The cached WAVs all share one format, so a single concat-demuxer pass only has to
+    # encode the MP3; no per-job decoding once the snippets are cached
     cmd = ['ffmpeg','-y','-f','concat','-safe','0','-i',concat_txt,'-c:a','libmp3lame','-q:a','2', out_mp3]
     try:
         subprocess.run(cmd, check=True)
@@ -83,32 +276,70 @@ def build_concat_and_render(jobdir, job, phonemes):
     except subprocess.CalledProcessError as e:
         return False, str(e)
 
+def process_job(jd):
+    job = read_job(jd)
+    if not job:
+        return
+    if job.get('status') and job['status'] != 'queued':
+        return
+    job['status'] = 'processing'
+    write_job(jd, job)
+    phonemes = phoneticize(job['text'])
+    if not phonemes:
+        job['status'] = 'failed'
+        job['error'] = 'phoneticize_failed'
+        write_job(jd, job)
+        return
+    ok, result = build_concat_and_render(jd, job, phonemes)
+    if ok:
+        job['status'] = 'done'
+        job['output'] = result
+    else:
+        job['status'] = 'failed'
+        job['error'] = result
+    write_job(jd, job)
+
+# job dirs queued or running on the pool; a dir is never handled by two threads at once
+_inflight = set()
+_inflight_lock = threading.Lock()
+
+def _run_job(jd):
+    try:
+        process_job(jd)
+    except Exception as e:
+        print('Worker error', e)
+    finally:
+        with _inflight_lock:
+            _inflight.discard(jd)
+
+def process_jobs(executor, jobdirs):
+    """Hand each job dir to the pool unless it is already in flight; returns immediately."""
+    for jd in jobdirs:
+        with _inflight_lock:
+            if jd in _inflight:
+                continue
+            _inflight.add(jd)
+        executor.submit(_run_job, jd)
+
 if __name__ == '__main__':
-    print('Renderer worker started, polling', os.path.join(WORKSPACE,'render_jobs'))
-    while True:
-        try:
-            jobs = list_jobs()
-            for jd in jobs:
-                job = read_job(jd)
-                if not job: continue
-                if job.get('status') and job['status'] != 'queued':
-                    continue
-                job['status'] = 'processing'
-                write_job(jd, job)
-                phonemes = call_ollama_phoneticize(job['text'])
-                if not phonemes:
-                    job['status'] = 'failed'
-                    job['error'] = 'phoneticize_failed'
-                    write_job(jd, job)
-                    continue
-                ok, result = build_concat_and_render(jd, job, phonemes)
-                if ok:
-                    job['status'] = 'done'
-                    job['output'] = result
-                else:
-                    job['status'] = 'failed'
-                    job['error'] = result
-                write_job(jd, job)
-        except Exception as e:
-            print('Worker error', e)
-        time.sleep(5)
+    print('Renderer worker started, watching', RENDER_ROOT)
+    os.makedirs(RENDER_ROOT, exist_ok=True)
+    executor = ThreadPoolExecutor(max_workers=CONCURRENCY)
+    if watch is None:
+        print('watchfiles not available; polling every 5 seconds')
+        process_jobs(executor, list_jobs())
+        while True:
+            time.sleep(5)
+            process_jobs(executor, list_jobs())
+    # Sleep in the kernel until a job.json is written. The watcher is registered before the
+    # first yield, so the startup sweep runs then and cannot miss a job written during it; a
+    # periodic sweep still picks up anything missed (e.g. jobs written while restarting).
+    last_sweep = None
+    for changes in watch(RENDER_ROOT, recursive=True, step=50,
+                         rust_timeout=WATCH_TICK_MS, yield_on_timeout=True):
+        if last_sweep is None or time.monotonic() - last_sweep >= HOUSEKEEPING_INTERVAL:
+            last_sweep = time.monotonic()
+            process_jobs(executor, list_jobs())
+            continue
+        jobdirs = {os.path.dirname(p) for _, p in changes if os.path.basename(p) == 'job.json'}
+        process_jobs(executor, sorted(d for d in jobdirs if os.path.dirname(d) == RENDER_ROOT))
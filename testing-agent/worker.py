@@ -3,9 +3,14 @@ import sys
 import time
 import json
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 import subprocess
 import shlex
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import xml.etree.ElementTree as ET
@@ -16,12 +21,27 @@ try:
     from utils import runner as runner_utils
 except Exception:
     runner_utils = None
+try:
+    from watchfiles import watch
+except Exception:
+    watch = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 WORKSPACE = os.environ.get('WORKSPACE', '/workspace')
 MANAGER_URL = os.environ.get('MANAGER_URL', 'http://manager:8080')
 MANAGER_API_TOKEN = os.environ.get('MANAGER_API_TOKEN')
 TASKS_DIR = os.path.join(WORKSPACE, 'tasks')
 CONCURRENCY = int(os.environ.get('TESTING_CONCURRENCY', '2'))
+# Safety-net full sweep interval while watching for changes
+HOUSEKEEPING_INTERVAL = float(os.environ.get('TESTING_HOUSEKEEPING_INTERVAL', '60'))
+# inotify does not see changes made by other hosts on NFS-mounted workspaces
+FORCE_POLLING = os.environ.get('TESTING_FORCE_POLLING', '').lower() == 'true'
+# watch() wakes at least this often (ms) so the first sweep runs right after the watcher is
+# registered and housekeeping is time-based rather than waiting for an idle gap
+WATCH_TICK_MS = 1000
 
 os.makedirs(TASKS_DIR, exist_ok=True)
 
@@ -29,15 +49,71 @@ HEADERS = {}
 if MANAGER_API_TOKEN:
     HEADERS['Authorization'] = f"Bearer {MANAGER_API_TOKEN}"
 
+# All status updates go to the manager; keep those connections alive between calls
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(8, CONCURRENCY), max_retries=0)
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+
 print('Testing agent started, workspace:', WORKSPACE, 'manager:', MANAGER_URL, 'concurrency=', CONCURRENCY)
 
 
+def _read_json(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _dumps(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def _atomic_write(path, data, fsync=False):
+    # readers (the manager's test report endpoint) never see a half-written file
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _write_report(report_file, result, exit_code, output):
+    header = f"RESULT: {result}\nEXIT_CODE: {exit_code}\nTIMESTAMP: {datetime.utcnow().isoformat()}Z\n--- OUTPUT ---\n"
+    _atomic_write(report_file, (header + output).encode('utf-8', errors='replace'))
+
+
 def read_meta(task_dir):
-    meta_file = os.path.join(task_dir, 'meta.json')
-    if not os.path.exists(meta_file):
+    try:
+        return _read_json(os.path.join(task_dir, 'meta.json'))
+    except FileNotFoundError:
         return None
-    with open(meta_file) as f:
-        return json.load(f)
+
+
+# spec.yaml path -> (st_mtime_ns, st_size, parsed spec); specs rarely change once written
+_spec_cache = {}
+
+
+def read_spec(task_dir):
+    spec_path = os.path.join(task_dir, 'spec.yaml')
+    try:
+        st = os.stat(spec_path)
+    except FileNotFoundError:
+        _spec_cache.pop(spec_path, None)
+        return {}
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _spec_cache.get(spec_path)
+    if cached and cached[:2] == key:
+        return cached[2]
+    try:
+        with open(spec_path) as f:
+            spec = yaml.load(f, Loader=SafeLoader) or {}
+    except Exception:
+        return {}
+    _spec_cache[spec_path] = (*key, spec)
+    return spec
 
 
 def write_junit_xml(report_xml_path, task_id, success, exit_code, output):
@@ -114,43 +190,43 @@ def run_tests(task_dir, spec, run_dir=None):
             success = (ret == 0)
             output = out or ''
             # write report
-            with open(report_file, 'w') as f:
-                f.write(f"RESULT: {'PASS' if success else 'FAIL'}\n")
-                f.write(f"EXIT_CODE: {ret}\n")
-                f.write(f"TIMESTAMP: {datetime.utcnow().isoformat()}Z\n")
-                f.write("--- OUTPUT ---\n")
-                f.write(output or "(no output)\n")
+            _write_report(report_file, 'PASS' if success else 'FAIL', ret, output or "(no output)\n")
             write_junit_xml(report_xml, os.path.basename(task_dir), success, ret, output)
             return success, report_file
         except Exception as e:
-            with open(report_file, 'w') as f:
-                f.write(f"RESULT: ERROR\nEXIT_CODE: ERROR\nTIMESTAMP: {datetime.utcnow().isoformat()}Z\n--- OUTPUT ---\nRemote test error: {e}\n")
+            _write_report(report_file, 'ERROR', 'ERROR', f"Remote test error: {e}\n")
             write_junit_xml(report_xml, os.path.basename(task_dir), False, 'ERROR', f'Remote test error: {e}')
             return False, report_file
 
     # Fallback to local execution
     try:
-        proc = subprocess.run(cmd, cwd=target_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60)
-        output = proc.stdout.decode('utf-8', errors='replace')
-        success = proc.returncode == 0
+        # The test process writes straight to a spill file (no pipe for Python to drain), so
+        # output produced before a timeout kill is kept in the report
+        out_path = report_file + '.out'
+        with open(out_path, 'wb') as out_f:
+            proc = subprocess.Popen(cmd, cwd=target_dir, stdout=out_f, stderr=subprocess.STDOUT)
+            try:
+                returncode = proc.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+                returncode = None
+        with open(out_path, 'rb') as f:
+            output = f.read().decode('utf-8', errors='replace')
+        os.remove(out_path)
+        if returncode is None:
+            output += f"\nTimeout: {cmd} did not finish within 60 seconds\n"
+            _write_report(report_file, 'FAIL', 'TIMEOUT', output)
+            write_junit_xml(report_xml, os.path.basename(task_dir), False, 'TIMEOUT', output)
+            return False, report_file
+        success = returncode == 0
         # Always write a summary header followed by the raw output so reports are informative
-        with open(report_file, 'w') as f:
-            f.write(f"RESULT: {'PASS' if success else 'FAIL'}\n")
-            f.write(f"EXIT_CODE: {proc.returncode}\n")
-            f.write(f"TIMESTAMP: {datetime.utcnow().isoformat()}Z\n")
-            f.write("--- OUTPUT ---\n")
-            f.write(output or "(no output)\n")
+        _write_report(report_file, 'PASS' if success else 'FAIL', returncode, output or "(no output)\n")
         # Write JUnit XML for CI
-        write_junit_xml(report_xml, os.path.basename(task_dir), success, proc.returncode, output)
+        write_junit_xml(report_xml, os.path.basename(task_dir), success, returncode, output)
         return success, report_file
-    except subprocess.TimeoutExpired as e:
-        with open(report_file, 'w') as f:
-            f.write(f"RESULT: FAIL\nEXIT_CODE: TIMEOUT\nTIMESTAMP: {datetime.utcnow().isoformat()}Z\n--- OUTPUT ---\nTimeout: {e}\n")
-        write_junit_xml(report_xml, os.path.basename(task_dir), False, 'TIMEOUT', f'Timeout: {e}')
-        return False, report_file
     except Exception as e:
-        with open(report_file, 'w') as f:
-            f.write(f"RESULT: ERROR\nEXIT_CODE: ERROR\nTIMESTAMP: {datetime.utcnow().isoformat()}Z\n--- OUTPUT ---\nError running tests: {e}\n")
+        _write_report(report_file, 'ERROR', 'ERROR', f"Error running tests: {e}\n")
         write_junit_xml(report_xml, os.path.basename(task_dir), False, 'ERROR', f'Error running tests: {e}')
         return False, report_file
 
@@ -165,7 +241,7 @@ def process_task(name):
         return
     # Attempt to claim the task by setting status to 'testing'
     try:
-        r = requests.post(f"{MANAGER_URL}/api/tasks/{name}/status", json={'status': 'testing'}, headers=HEADERS, timeout=5)
+        r = SESSION.post(f"{MANAGER_URL}/api/tasks/{name}/status", json={'status': 'testing'}, timeout=5)
         if r.status_code != 200:
             # Could not claim
             return
@@ -173,14 +249,7 @@ def process_task(name):
         print('Failed to claim task', name, e)
         return
     # Re-read spec
-    spec = {}
-    spec_path = os.path.join(task_dir, 'spec.yaml')
-    if os.path.exists(spec_path):
-        try:
-            with open(spec_path) as f:
-                spec = yaml.safe_load(f) or {}
-        except Exception:
-            spec = {}
+    spec = read_spec(task_dir)
     related = spec.get('related_task') if spec else None
     run_dir = None
     if related:
@@ -189,7 +258,7 @@ def process_task(name):
     # Determine new status
     new_status = 'tested' if ok else 'failed'
     try:
-        requests.post(f"{MANAGER_URL}/api/tasks/{name}/status", json={'status': new_status}, headers=HEADERS, timeout=5)
+        SESSION.post(f"{MANAGER_URL}/api/tasks/{name}/status", json={'status': new_status}, timeout=5)
     except Exception as e:
         print('Failed to update manager status', e)
     # write test_records
@@ -198,37 +267,65 @@ def process_task(name):
     records = []
     if os.path.exists(records_file):
         try:
-            with open(records_file) as f:
-                records = json.load(f)
+            records = _read_json(records_file)
         except Exception:
             records = []
     records.append(rec)
-    with open(records_file, 'w') as f:
-        json.dump(records, f)
+    # cumulative history, so this one is always fsynced
+    _atomic_write(records_file, _dumps(records), fsync=True)
     print(f'Processed tests for {name}: ok={ok} report={info}')
 
 
-while True:
-    try:
-        candidates = []
-        for name in os.listdir(TASKS_DIR):
-            task_dir = os.path.join(TASKS_DIR, name)
-            if not os.path.isdir(task_dir):
-                continue
-            meta = read_meta(task_dir)
-            if not meta:
+def handle_tasks(executor, names):
+    """Test the given tasks that are ready, on the pool, and wait for the batch to finish so
+    the same task is never handled by two threads at once."""
+    candidates = []
+    for name in names:
+        meta = read_meta(os.path.join(TASKS_DIR, name))
+        if meta and meta.get('status') in ('completed', 'ready_for_test'):
+            candidates.append(name)
+    futures = {executor.submit(process_task, name): name for name in candidates}
+    for fut in as_completed(futures):
+        try:
+            fut.result()
+        except Exception as e:
+            print('Test worker error for', futures[fut], e)
+
+
+def sweep(executor):
+    """Check every task directory; used at startup and as periodic housekeeping."""
+    with os.scandir(TASKS_DIR) as it:
+        names = [entry.name for entry in it if entry.is_dir(follow_symlinks=False)]
+    handle_tasks(executor, names)
+
+
+def main():
+    executor = ThreadPoolExecutor(max_workers=CONCURRENCY)
+    if watch is None:
+        print('watchfiles not available; polling every 5 seconds')
+        sweep(executor)
+        while True:
+            time.sleep(5)
+            try:
+                sweep(executor)
+            except Exception as e:
+                print('Testing worker main loop error', e)
+    # Only the task whose meta.json changed is re-read. The watcher is registered before the
+    # first yield, so the startup sweep runs then and cannot miss a write made during it; the
+    # housekeeping sweep then runs every HOUSEKEEPING_INTERVAL however busy the directory is.
+    last_sweep = None
+    for changes in watch(TASKS_DIR, recursive=True, force_polling=FORCE_POLLING,
+                         rust_timeout=WATCH_TICK_MS, yield_on_timeout=True):
+        try:
+            if last_sweep is None or time.monotonic() - last_sweep >= HOUSEKEEPING_INTERVAL:
+                last_sweep = time.monotonic()
+                sweep(executor)
                 continue
-            status = meta.get('status')
-            if status in ('completed', 'ready_for_test'):
-                candidates.append(name)
-        if candidates:
-            with ThreadPoolExecutor(max_workers=CONCURRENCY) as ex:
-                futures = {ex.submit(process_task, name): name for name in candidates}
-                for fut in as_completed(futures):
-                    try:
-                        fut.result()
-                    except Exception as e:
-                        print('Test worker error for', futures[fut], e)
-    except Exception as e:
-        print('Testing worker main loop error', e)
-    time.sleep(5)
+            task_dirs = {os.path.dirname(path) for _, path in changes if os.path.basename(path) == 'meta.json'}
+            handle_tasks(executor, [os.path.basename(d) for d in task_dirs if os.path.dirname(d) == TASKS_DIR])
+        except Exception as e:
+            print('Testing worker main loop error', e)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import importlib
+import json
+import os
+
+import pytest
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+@pytest.fixture(scope='session')
+def manager_module(tmp_path_factory):
+    # import manager.app once; WORKSPACE must point somewhere writable before the import
+    mp = pytest.MonkeyPatch()
+    mp.setenv('WORKSPACE', str(tmp_path_factory.mktemp('workspace')))
+    try:
+        return importlib.import_module('manager.app')
+    finally:
+        mp.undo()
+
+
+TEST_TOKEN = 'test-token-123'
+SPECS_DIR = os.path.join(os.path.dirname(__file__), '..', 'specs')
+
+
+@pytest.fixture(scope='session')
+def create_blog_spec():
+    # parsed once; tests must copy before mutating it
+    with open(os.path.join(SPECS_DIR, 'create-blog.json'), 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+@pytest.fixture(scope='session')
+def dockerfile_php():
+    with open('Dockerfile.php', 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture(scope='session')
+def _app_client(manager_module):
+    # auth is read from app.config per request, so no env var or re-import is needed
+    manager_module.app.config['API_TOKEN'] = TEST_TOKEN
+    with manager_module.app.test_client() as c:
+        yield c
+
+
+@pytest.fixture
+def client(_app_client, manager_module, tmp_path, monkeypatch):
+    # same app and client for every test, fresh workspace each time
+    monkeypatch.setenv('WORKSPACE', str(tmp_path))
+    previous = manager_module.WORKSPACE
+    manager_module.configure_workspace(str(tmp_path))
+    yield _app_client
+    manager_module.configure_workspace(previous)
+
+
+@pytest.fixture
+def auth_headers():
+    return {'Authorization': f"Bearer {TEST_TOKEN}"}
+
+
+@pytest.fixture
+def task_factory(client, auth_headers):
+    """Create a minimal coding task through the API and return its meta."""
+    def _mk(task_id, **fields):
+        payload = {'id': task_id, 'title': task_id, 'owner': 'manager', 'kind': 'coding', **fields}
+        resp = client.post('/api/tasks', json=payload, headers=auth_headers)
+        assert resp.status_code == 201, resp.get_data(as_text=True)
+        return resp.get_json()
+    return _mk
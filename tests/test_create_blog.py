@@ -1,37 +1,22 @@
 import os
 import json
-import importlib
-import sys
-import tempfile
 
 import yaml
-import pytest
 
+try:
+    from yaml import CSafeLoader as _YL
+except ImportError:
+    from yaml import SafeLoader as _YL
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def test_post_project_manifest_creates_task(tmp_path, monkeypatch):
-    # Set WORKSPACE to a fresh temporary directory before importing the manager app
-    monkeypatch.setenv('WORKSPACE', str(tmp_path))
 
-    # Ensure fresh import of the manager app so it picks up the env var
-    if 'manager.app' in sys.modules:
-        del sys.modules['manager.app']
-    manager = importlib.import_module('manager.app')
-
-    client = manager.app.test_client()
-
-    # Load the sample project manifest (JSON) from specs/create-blog.json
-    repo_root = os.path.dirname(manager.__file__)
-    specs_path = os.path.normpath(os.path.join(repo_root, '..', 'specs', 'create-blog.json'))
-    assert os.path.exists(specs_path), f"spec file not found: {specs_path}"
-    with open(specs_path) as f:
-        payload = json.load(f)
-
-    # If the manager requires API token auth, include it in headers
-    headers = {}
-    token = os.environ.get('MANAGER_API_TOKEN')
-    if token:
-        headers['Authorization'] = f"Bearer {token}"
-    resp = client.post('/api/tasks', json=payload, headers=headers)
+def test_post_project_manifest_creates_task(client, create_blog_spec, auth_headers, tmp_path):
+    # sample project manifest from specs/create-blog.json, parsed once per session
+    payload = create_blog_spec
+    resp = client.post('/api/tasks', json=payload, headers=auth_headers)
     assert resp.status_code == 201, resp.get_data(as_text=True)
     meta = resp.get_json()
     assert 'id' in meta
@@ -46,6 +31,35 @@ def test_post_project_manifest_creates_task(tmp_path, monkeypatch):
 
     # Load written spec and check it contains embedded project manifest
     with open(spec_file) as f:
-        written = yaml.safe_load(f)
+        written = yaml.load(f, Loader=_YL)
     assert 'project' in written, 'original project manifest not embedded in saved spec'
     assert written['project']['slug'] == payload['slug']
+
+
+def test_invalid_task_spec_is_rejected(client, auth_headers, tmp_path):
+    # 'kind' is outside the task schema enum
+    resp = client.post('/api/tasks', json={'id': 'bad-task', 'title': 'Bad', 'owner': 'manager', 'kind': 'nope'}, headers=auth_headers)
+    assert resp.status_code == 400
+    body = resp.get_json()
+    assert body['error'] == 'spec validation failed'
+    assert 'nope' in body['message']
+    assert not os.path.exists(os.path.join(str(tmp_path), 'tasks', 'bad-task'))
+
+
+def test_spec_cache_sidecar_matches_yaml(task_factory, tmp_path):
+    task_factory('cached-task')
+
+    task_dir = os.path.join(str(tmp_path), 'tasks', 'cached-task')
+    with open(os.path.join(task_dir, 'spec.yaml')) as f:
+        from_yaml = yaml.load(f, Loader=_YL)
+    with open(os.path.join(task_dir, 'spec.cache.json'), 'rb') as f:
+        from_json = orjson.loads(f.read()) if orjson else json.load(f)
+    assert from_json == from_yaml
+    assert os.path.getmtime(os.path.join(task_dir, 'spec.cache.json')) >= os.path.getmtime(os.path.join(task_dir, 'spec.yaml'))
+
+
+def test_plain_task_with_name_field_is_not_treated_as_manifest(client, auth_headers):
+    payload = {'id': 'named-task', 'title': 'named', 'owner': 'manager', 'kind': 'coding', 'name': 'not a manifest'}
+    resp = client.post('/api/tasks', json=payload, headers=auth_headers)
+    assert resp.status_code == 201, resp.get_data(as_text=True)
+    assert resp.get_json()['id'] == 'named-task'
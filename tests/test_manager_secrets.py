@@ -1,37 +1,17 @@
 import os
 import json
-import importlib
-import sys
 
-import pytest
-
-
-def test_upload_env_writes_env_file(tmp_path, monkeypatch):
-    # set workspace
-    monkeypatch.setenv('WORKSPACE', str(tmp_path))
-    # ensure fresh import
-    if 'manager.app' in sys.modules:
-        del sys.modules['manager.app']
-    manager = importlib.import_module('manager.app')
-    client = manager.app.test_client()
 
+def test_upload_env_writes_env_file(client, create_blog_spec, auth_headers, tmp_path):
     # create a task via POST using sample manifest
-    repo_root = os.path.dirname(manager.__file__)
-    specs_path = os.path.normpath(os.path.join(repo_root, '..', 'specs', 'create-blog.json'))
-    with open(specs_path) as f:
-        payload = json.load(f)
-    headers = {}
-    token = os.environ.get('MANAGER_API_TOKEN')
-    if token:
-        headers['Authorization'] = f"Bearer {token}"
-    resp = client.post('/api/tasks', json=payload, headers=headers)
+    resp = client.post('/api/tasks', json=create_blog_spec, headers=auth_headers)
     assert resp.status_code == 201
     meta = resp.get_json()
     task_id = meta['id']
 
     # upload env JSON
     env_payload = {'env': {'OLLAMA_URL': 'https://example/', 'OLLAMA_KEY': 'secret'}}
-    resp = client.post(f'/api/tasks/{task_id}/secrets', json=env_payload, headers=headers)
+    resp = client.post(f'/api/tasks/{task_id}/secrets', json=env_payload, headers=auth_headers)
     assert resp.status_code == 201
     data = resp.get_json()
     assert '.env' in data['files']
@@ -52,23 +32,9 @@ def test_upload_env_writes_env_file(tmp_path, monkeypatch):
     assert '.env' in m.get('secret_files', [])
 
 
-def test_file_upload_saves_file(tmp_path, monkeypatch):
-    monkeypatch.setenv('WORKSPACE', str(tmp_path))
-    if 'manager.app' in sys.modules:
-        del sys.modules['manager.app']
-    manager = importlib.import_module('manager.app')
-    client = manager.app.test_client()
-
+def test_file_upload_saves_file(client, create_blog_spec, auth_headers, tmp_path):
     # create a task
-    repo_root = os.path.dirname(manager.__file__)
-    specs_path = os.path.normpath(os.path.join(repo_root, '..', 'specs', 'create-blog.json'))
-    with open(specs_path) as f:
-        payload = json.load(f)
-    headers = {}
-    token = os.environ.get('MANAGER_API_TOKEN')
-    if token:
-        headers['Authorization'] = f"Bearer {token}"
-    resp = client.post('/api/tasks', json=payload, headers=headers)
+    resp = client.post('/api/tasks', json=create_blog_spec, headers=auth_headers)
     assert resp.status_code == 201
     meta = resp.get_json()
     task_id = meta['id']
@@ -76,10 +42,25 @@ def test_file_upload_saves_file(tmp_path, monkeypatch):
     import io
     data = {'file1': (io.BytesIO(b'secret-data'), 'mykey.pem')}
     # Flask test client expects content_type multipart/form-data when sending files
-    resp = client.post(f'/api/tasks/{task_id}/secrets', data=data, content_type='multipart/form-data', headers=headers)
+    resp = client.post(f'/api/tasks/{task_id}/secrets', data=data, content_type='multipart/form-data', headers=auth_headers)
     assert resp.status_code == 201
     res = resp.get_json()
     assert 'mykey.pem' in res['files']
     secrets_dir = tmp_path / 'tasks' / task_id / 'secrets'
     assert (secrets_dir / 'mykey.pem').exists()
     assert (secrets_dir / 'mykey.pem').read_bytes() == b'secret-data'
+
+
+def test_create_task_writes_deployment_secrets_0600(client, auth_headers, tmp_path):
+    payload = {'id': 'secret-task', 'title': 'secrets', 'owner': 'manager', 'kind': 'deployment',
+               'deployment': {'env': {'A': '1', 'B': '2'}, 'secrets': ['api_key', '../escape', '.hidden']}}
+    resp = client.post('/api/tasks', json=payload, headers=auth_headers)
+    assert resp.status_code == 201, resp.get_data(as_text=True)
+
+    secrets_dir = tmp_path / 'tasks' / 'secret-task' / 'secrets'
+    assert (secrets_dir / '.env').read_text() == 'A=1\nB=2\n'
+    assert (secrets_dir / 'api_key').read_bytes() == b''
+    assert not (tmp_path / 'tasks' / 'secret-task' / 'escape').exists()
+    assert not (secrets_dir / '.hidden').exists()
+    for name in ('.env', 'api_key'):
+        assert os.stat(secrets_dir / name).st_mode & 0o777 == 0o600
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+
+def test_status_batch_updates_each_task(client, auth_headers, task_factory, tmp_path):
+    ids = [task_factory(task_id)['id'] for task_id in ('batch-a', 'batch-b')]
+
+    items = [{'id': i, 'status': 'completed'} for i in ids] + [{'id': 'missing-task', 'status': 'completed'}]
+    resp = client.post('/api/tasks/status_batch', json=items, headers=auth_headers)
+    assert resp.status_code == 200
+    results = resp.get_json()
+    assert [r.get('status') for r in results[:2]] == ['completed', 'completed']
+    assert results[2] == {'id': 'missing-task', 'error': 'not found'}
+
+    for i in ids:
+        meta = json.loads((tmp_path / 'tasks' / i / 'meta.json').read_text())
+        assert meta['status'] == 'completed'
+        assert 'updated_at' in meta
+
+
+def test_status_batch_rejects_non_list(client, auth_headers):
+    resp = client.post('/api/tasks/status_batch', json={'id': 'x', 'status': 'completed'}, headers=auth_headers)
+    assert resp.status_code == 400
+
+
+def test_traversal_task_ids_are_rejected(client, auth_headers, task_factory, tmp_path):
+    resp = client.get('/api/tasks/..', headers=auth_headers)
+    assert resp.status_code == 400
+    assert resp.get_json() == {'error': 'invalid task id'}
+    resp = client.post('/api/tasks/status_batch', json=[{'id': '../escape', 'status': 'completed'}], headers=auth_headers)
+    assert resp.get_json() == [{'id': '../escape', 'error': 'invalid id'}]
+    resp = client.post('/api/tasks', json={'id': '../escape', 'title': 'x'}, headers=auth_headers)
+    assert resp.status_code == 400
+    assert resp.get_json() == {'error': 'invalid task id'}
+    assert not (tmp_path / 'escape').exists()
+
+    # ids that stay a single path component are still accepted
+    for task_id in ('my task', 'tâche-1', 'v1..2'):
+        assert task_factory(task_id)['id'] == task_id
+        assert (tmp_path / 'tasks' / task_id / 'meta.json').exists()
+
+
+@pytest.mark.parametrize('path, body, expected', [
+    ('deploy', None, 'ready_for_deploy'),
+    ('status', {'status': 'completed'}, 'completed'),
+])
+def test_deployable_status_touches_pending_marker(client, auth_headers, task_factory, tmp_path, path, body, expected):
+    task_factory('pending-task')
+    marker = tmp_path / '.deploy_pending'
+
+    client.post('/api/tasks/pending-task/status', json={'status': 'in_progress'}, headers=auth_headers)
+    assert not marker.exists()
+    resp = client.post(f'/api/tasks/pending-task/{path}', json=body, headers=auth_headers)
+    assert resp.status_code == 200
+    assert resp.get_json()['status'] == expected
+    assert marker.exists()
+
+
+def test_requests_without_the_api_token_are_rejected(client, auth_headers, tmp_path):
+    payload = {'id': 'auth-task', 'title': 'auth', 'owner': 'manager', 'kind': 'coding'}
+    resp = client.post('/api/tasks', json=payload)
+    assert resp.status_code == 401
+    resp = client.post('/api/tasks', json=payload, headers={'Authorization': 'Bearer wrong'})
+    assert resp.status_code == 401
+    assert not (tmp_path / 'tasks' / 'auth-task').exists()
+    token = auth_headers['Authorization'].split(' ', 1)[1]
+    resp = client.post('/api/tasks', json=payload, headers={'X-Api-Token': token})
+    assert resp.status_code == 201
@@ -0,0 +1,123 @@
+import os
+import json
+
+
+def _seed_tasks(tasks_dir, ids):
+    # write meta.json directly; only the listing under test goes through the app
+    for task_id in ids:
+        (tasks_dir / task_id).mkdir(parents=True)
+        (tasks_dir / task_id / 'meta.json').write_text(json.dumps({'id': task_id, 'status': 'created'}))
+
+
+def test_list_tasks_skips_entries_without_meta(client, tmp_path):
+    _seed_tasks(tmp_path / 'tasks', ['list-task-0', 'list-task-1', 'list-task-2'])
+
+    # stray file and an empty directory in the tasks dir must be ignored
+    (tmp_path / 'tasks' / 'stray.txt').write_text('x')
+    (tmp_path / 'tasks' / 'empty-dir').mkdir()
+
+    resp = client.get('/api/tasks')
+    assert resp.status_code == 200
+    tasks = resp.get_json()
+    assert sorted(t['id'] for t in tasks) == ['list-task-0', 'list-task-1', 'list-task-2']
+
+
+def test_deploy_history_merges_legacy_and_jsonl_records(client, tmp_path):
+    task_dir = tmp_path / 'tasks' / 'history-task'
+    task_dir.mkdir(parents=True)
+    resp = client.get('/api/tasks/history-task/deploys')
+    assert resp.status_code == 200
+    assert resp.get_json() == []
+
+    (task_dir / 'deploy_records.json').write_text(json.dumps([{'task': 'history-task', 'n': 1}]))
+    (task_dir / 'deploy_records.jsonl').write_text(
+        json.dumps({'task': 'history-task', 'n': 2}) + '\n' + json.dumps({'task': 'history-task', 'n': 3}) + '\n')
+    resp = client.get('/api/tasks/history-task/deploys')
+    assert resp.status_code == 200
+    assert [r['n'] for r in resp.get_json()] == [1, 2, 3]
+
+
+def test_rollback_repoints_current_symlink(client, auth_headers, tmp_path):
+    deploy_root = tmp_path / 'deploy' / 'rb-task'
+    for rev in ('20260101T000000Z', '20260102T000000Z'):
+        (deploy_root / 'revisions' / rev).mkdir(parents=True)
+        (deploy_root / 'revisions' / rev / 'index.html').write_text(rev)
+    os.symlink(os.path.join('revisions', '20260102T000000Z'), deploy_root / 'current')
+
+    resp = client.post('/api/tasks/rb-task/rollback', json={}, headers=auth_headers)
+    assert resp.status_code == 200, resp.get_data(as_text=True)
+    assert resp.get_json()['restored_from'] == '20260101T000000Z'
+    assert os.readlink(deploy_root / 'current') == os.path.join('revisions', '20260101T000000Z')
+    assert (deploy_root / 'current' / 'index.html').read_text() == '20260101T000000Z'
+
+
+def test_rollback_rejects_traversal_ids_with_json(client, auth_headers):
+    resp = client.post('/api/tasks/%2E%2E/rollback', json={}, headers=auth_headers)
+    assert resp.status_code == 400
+    assert resp.get_json() == {'error': 'invalid task id'}
+
+    # a single-component id with a space is a normal task id
+    resp = client.post('/api/tasks/my task/rollback', json={}, headers=auth_headers)
+    assert resp.status_code == 404
+    assert resp.get_json() == {'error': 'no deploy history for task'}
+
+
+def test_get_task_honours_etag(client, auth_headers, task_factory):
+    task_factory('etag-task')
+    resp = client.get('/api/tasks/etag-task', headers=auth_headers)
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    # no Last-Modified: its one-second resolution would let If-Modified-Since miss same-second changes
+    assert 'Last-Modified' not in resp.headers
+
+    resp = client.get('/api/tasks/etag-task', headers={**auth_headers, 'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.get_data() == b''
+
+    resp = client.post('/api/tasks/etag-task/status', json={'status': 'completed'}, headers=auth_headers)
+    assert resp.status_code == 200
+    resp = client.get('/api/tasks/etag-task', headers={**auth_headers, 'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.get_json()['status'] == 'completed'
+    resp = client.get('/api/tasks/etag-task', headers={**auth_headers, 'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+    assert resp.status_code == 200
+
+
+def test_latest_test_report_etag_tracks_the_report_file(client, auth_headers, tmp_path):
+    task_dir = tmp_path / 'tasks' / 'report-task'
+    (task_dir / 'test_reports').mkdir(parents=True)
+    report = task_dir / 'test_reports' / 'test-report-1.txt'
+    report.write_text('RESULT: FAIL\n')
+    (task_dir / 'test_records.json').write_text(json.dumps([{'report': 'report-task/test_reports/test-report-1.txt'}]))
+
+    resp = client.get('/api/tasks/report-task/tests/latest', headers=auth_headers)
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    resp = client.get('/api/tasks/report-task/tests/latest', headers={**auth_headers, 'If-None-Match': etag})
+    assert resp.status_code == 304
+
+    report.write_text('RESULT: PASS, rerun\n')
+    resp = client.get('/api/tasks/report-task/tests/latest', headers={**auth_headers, 'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.get_json()['report_content'] == 'RESULT: PASS, rerun\n'
+
+
+def test_latest_test_report_drops_etag_when_records_change_during_read(client, manager_module, auth_headers,
+                                                                       tmp_path, monkeypatch):
+    task_dir = tmp_path / 'tasks' / 'racy-task'
+    task_dir.mkdir(parents=True)
+    records_file = task_dir / 'test_records.json'
+    records_file.write_text(json.dumps([{'n': 1}]))
+    real_read_json = manager_module._read_json
+
+    def read_then_rewrite(path):
+        data = real_read_json(path)
+        # the testing agent appends a record right after this request read the old list
+        records_file.write_text(json.dumps([{'n': 1}, {'n': 2}]))
+        return data
+    monkeypatch.setattr(manager_module, '_read_json', read_then_rewrite)
+
+    resp = client.get('/api/tasks/racy-task/tests/latest', headers=auth_headers)
+    assert resp.status_code == 200
+    assert resp.get_json() == {'latest': {'n': 1}}
+    assert 'ETag' not in resp.headers
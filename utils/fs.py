@@ -0,0 +1,18 @@
+import os
+import threading
+
+
+def swap_symlink(target, link):
+    """Atomically point `link` at `target` (create a temp symlink, then rename over the old one).
+    The temp name is per process and thread, so a manager rollback and a concurrent deploy
+    swapping the same link never collide on it or publish each other's target."""
+    tmp = f"{link}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if os.path.lexists(tmp):
+        # left behind by a crashed swap from a recycled pid/thread id
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    try:
+        os.replace(tmp, link)
+    except OSError:
+        os.remove(tmp)
+        raise
@@ -1,6 +1,16 @@
 import os
+import shlex
 import subprocess
 import shutil
+import stat
+import tempfile
+import atexit
+import functools
+import hashlib
+import json
+import time
+import threading
+from collections import deque
 
 # Runner selection helper
 def _env_bool(name):
@@ -14,17 +24,13 @@ def select_runner(role='deploy'):
     """Selects runner for given role: 'deploy' or 'test'.
     Returns one of: 'remote-ssh', 'host-docker', 'dind', 'local'
     """
-    role = role.lower()
-    if role == 'deploy':
-        runner_env = os.environ.get('DEPLOY_RUNNER', 'auto')
-        remote_host = os.environ.get('EXTERNAL_DEPLOY_HOST')
-        remote_user = os.environ.get('EXTERNAL_DEPLOY_USER')
+    env = os.environ.get
+    if role.lower() == 'deploy':
+        runner_env = env('DEPLOY_RUNNER', 'auto')
+        remote_host = env('EXTERNAL_DEPLOY_HOST')
     else:
-        runner_env = os.environ.get('TEST_RUNNER', 'auto')
-        remote_host = os.environ.get('REMOTE_TEST_HOST')
-        remote_user = os.environ.get('REMOTE_TEST_USER')
-
-    docker_socket = os.environ.get('DOCKER_SOCKET_PATH', '/var/run/docker.sock')
+        runner_env = env('TEST_RUNNER', 'auto')
+        remote_host = env('REMOTE_TEST_HOST')
 
     runner_env = (runner_env or 'auto').lower()
     if runner_env != 'auto':
@@ -39,20 +45,109 @@ def select_runner(role='deploy'):
     # auto selection
     if remote_host:
         return 'remote-ssh'
-    if os.path.exists(docker_socket):
+    # only the auto path needs the socket location
+    if os.path.exists(env('DOCKER_SOCKET_PATH', '/var/run/docker.sock')):
         return 'host-docker'
     # dind detection could be implemented by env var; for now, prefer local
     return 'local'
 
 
-def _ssh_base_args(key_path=None, port=None, known_hosts=None):
+@functools.lru_cache(maxsize=None)
+def _which(name):
+    # the container's tool set doesn't change while the agent runs; walk $PATH once per tool
+    return shutil.which(name)
+
+
+def _allow_insecure_ssh():
+    # read per call so the opt-in can be flipped without restarting the agent
+    return os.environ.get('REMOTE_ALLOW_INSECURE_SSH', '').lower() == 'true'
+
+
+def _resolve_ssh_security(known_hosts, what='remote SSH'):
+    """Host key policy for one remote operation: returns allow_insecure, or raises RuntimeError
+    when there is neither a known_hosts file nor the REMOTE_ALLOW_INSECURE_SSH opt-in.
+    Resolve once at the entry point and pass the result down."""
+    allow_insecure = _allow_insecure_ssh()
+    if not known_hosts and not allow_insecure:
+        raise RuntimeError(f'{what}: known_hosts not provided. Set REMOTE_*_KNOWN_HOSTS or REMOTE_ALLOW_INSECURE_SSH=true (not recommended)')
+    return allow_insecure
+
+
+def _control_master_enabled():
+    return os.environ.get('REMOTE_SSH_CONTROL_MASTER', '').lower() != 'false' and _control_path() is not None
+
+
+@functools.lru_cache(maxsize=None)
+def _private_control_dir():
+    """The per-user socket dir, created (once) 0700. A shared /tmp path would let another local
+    user's master socket (or a squatted one) carry our sessions, so a dir that already exists must
+    be a real directory owned by us with no group/other access; otherwise returns None."""
+    control_dir = os.path.join(tempfile.gettempdir(), f'devsys-ssh-{os.getuid()}')
+    try:
+        os.mkdir(control_dir, 0o700)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        print('ssh ControlMaster disabled: cannot create', control_dir, e)
+        return None
+    st = os.lstat(control_dir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        print('ssh ControlMaster disabled:', control_dir, 'is not a private directory owned by this user')
+        return None
+    return control_dir
+
+
+def _control_path():
+    """ControlPath for ssh, or None when no safe socket location is available."""
+    configured = os.environ.get('REMOTE_SSH_CONTROL_PATH')
+    if configured:
+        return configured
+    control_dir = _private_control_dir()
+    if control_dir is None:
+        return None
+    return os.path.join(control_dir, '%r@%h:%p')
+
+
+def _control_master_opts():
+    """ssh -o options that multiplex sessions to the same host over one master connection,
+    so a deploy's mkdir, rsync and docker compose calls share a single SSH handshake.
+    Disable with REMOTE_SSH_CONTROL_MASTER=false."""
+    if not _control_master_enabled():
+        return []
+    persist = os.environ.get('REMOTE_SSH_CONTROL_PERSIST', '600s')
+    return ['-o', 'ControlMaster=auto', '-o', f'ControlPath={_control_path()}', '-o', f'ControlPersist={persist}']
+
+
+# (user, host, port) of every master this process may have started; closed at exit
+_masters = set()
+_masters_lock = threading.Lock()
+
+
+def _remember_master(user, host, port):
+    if _control_master_enabled():
+        with _masters_lock:
+            _masters.add((user, host, port))
+
+
+@atexit.register
+def _close_masters():
+    with _masters_lock:
+        targets = list(_masters)
+        _masters.clear()
+    for user, host, port in targets:
+        # -O exit is a local request to the master; it never opens a new connection
+        subprocess.run(['ssh', '-o', f'ControlPath={_control_path()}', '-p', str(port or 22), '-O', 'exit', f'{user}@{host}'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+
+@functools.lru_cache(maxsize=64)
+def _ssh_base_args_cached(key_path, port, known_hosts, allow_insecure, control_opts):
     args = ['ssh']
     if key_path:
         args += ['-i', key_path]
     if port:
         args += ['-p', str(port)]
-    # If known_hosts provided, enforce strict checking; otherwise require explicit opt-in via env
-    allow_insecure = os.environ.get('REMOTE_ALLOW_INSECURE_SSH', '').lower() == 'true'
+    # If known_hosts provided, enforce strict checking; otherwise require the explicit opt-in
     if known_hosts:
         args += ['-o', f'UserKnownHostsFile={known_hosts}', '-o', 'StrictHostKeyChecking=yes']
     else:
@@ -60,22 +155,214 @@ def _ssh_base_args(key_path=None, port=None, known_hosts=None):
             raise RuntimeError('No known_hosts provided for remote SSH. Set REMOTE_*_KNOWN_HOSTS or set REMOTE_ALLOW_INSECURE_SSH=true to override (not recommended).')
         args += ['-o', 'StrictHostKeyChecking=no']
     args += ['-o', 'BatchMode=yes']
-    return args
+    args += control_opts
+    return tuple(args)
+
+
+def _ssh_base_args(key_path=None, port=None, known_hosts=None, allow_insecure=None):
+    # allow_insecure comes from _resolve_ssh_security at the entry point; None reads the env here.
+    # The control-master opts are part of the cache key, so changing them still takes effect;
+    # callers get a fresh list they can extend
+    if allow_insecure is None:
+        allow_insecure = _allow_insecure_ssh()
+    return list(_ssh_base_args_cached(key_path, port, known_hosts, allow_insecure, tuple(_control_master_opts())))
+
+
+# Single files above this size are copied whole (no rsync delta pass, no compression)
+REMOTE_COPY_WHOLE_FILE_BYTES = int(os.environ.get('REMOTE_COPY_WHOLE_FILE_BYTES', str(64 * 1024 * 1024)))
+
+# Wire compression for remote_copy: zlib (rsync -z / tar -z, the default), zstd or none.
+# zstd needs rsync >= 3.2 on both ends for rsync, and the zstd binary on both ends for the tar pipe;
+# locally it falls back to zlib when either is missing
+REMOTE_COPY_COMPRESS = os.environ.get('REMOTE_COPY_COMPRESS', 'zlib').lower()
+
+
+@functools.lru_cache(maxsize=None)
+def _rsync_version():
+    """(major, minor) of the local rsync, or (0, 0) if it can't be determined."""
+    try:
+        out = subprocess.run(['rsync', '--version'], capture_output=True, timeout=10).stdout.decode(errors='replace')
+        # first line: "rsync  version 3.2.7  protocol version 31"
+        major, minor = out.split('version', 1)[1].split()[0].split('.')[:2]
+        return int(major), int(minor)
+    except Exception:
+        return 0, 0
+
+
+def _copy_compression(tool):
+    """Effective REMOTE_COPY_COMPRESS for tool ('rsync' or 'tar')."""
+    mode = REMOTE_COPY_COMPRESS
+    if mode == 'zstd':
+        if not _which('zstd') or (tool == 'rsync' and _rsync_version() < (3, 2)):
+            return 'zlib'
+    elif mode not in ('zlib', 'none'):
+        return 'zlib'
+    return mode
+
+
+def _rsync_compress_flags():
+    mode = _copy_compression('rsync')
+    if mode == 'zstd':
+        return ['--compress', '--compress-choice=zstd', '--compress-level=3']
+    if mode == 'zlib':
+        return ['--compress']
+    return []
+
+
+# Skip a remote_copy whose source tree is unchanged since the last successful copy to the same
+# target; entries expire after REMOTE_COPY_CACHE_TTL seconds, REMOTE_COPY_FORCE=true bypasses.
+# A local hit is only trusted once the remote confirms it: every successful copy leaves the
+# fingerprint in a stamp under REMOTE_COPY_STAMP_DIR on the remote (named by a hash of the
+# destination, so it never sits inside a deployed tree), and the skip requires the destination to
+# still exist with a matching stamp (so a wiped /tmp on the remote means a fresh copy)
+REMOTE_COPY_STAMP_DIR = os.environ.get('REMOTE_COPY_STAMP_DIR', '.cache/devsys/remote-copy')
+REMOTE_COPY_CACHE_TTL = int(os.environ.get('REMOTE_COPY_CACHE_TTL', str(24 * 3600)))
+REMOTE_COPY_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                 'devsys', 'remote_copy.json')
+_copy_cache_lock = threading.Lock()
+
+
+# Bookkeeping the agents rewrite on every status change, deploy or test run. Skipped at the top of
+# a copied task dir so the fingerprint only changes when the task's actual content does.
+_FINGERPRINT_SKIP = frozenset({'meta.json', 'spec.cache.json', 'deploy_records.json', 'deploy_records.jsonl',
+                               'test_records.json', 'reports'})
+
+
+def _tree_fingerprint(src):
+    """sha256 over (relative path, size, mtime_ns) of every file under src; no file contents are read."""
+    entries = []
+    if os.path.isdir(src):
+        for root, dirs, files in os.walk(src):
+            if root == src:
+                dirs[:] = [d for d in dirs if d not in _FINGERPRINT_SKIP]
+                files = [f for f in files if f not in _FINGERPRINT_SKIP]
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append(f"{os.path.relpath(path, src)}\0{st.st_size}\0{st.st_mtime_ns}")
+    else:
+        st = os.stat(src)
+        entries.append(f"\0{st.st_size}\0{st.st_mtime_ns}")
+    return hashlib.sha256('\n'.join(entries).encode()).hexdigest()
+
+
+def _load_copy_cache():
+    try:
+        with open(REMOTE_COPY_CACHE, 'rb') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def _copy_is_current(key, fingerprint):
+    if os.environ.get('REMOTE_COPY_FORCE', '').lower() == 'true':
+        return False
+    with _copy_cache_lock:
+        hit = _load_copy_cache().get(key)
+    return bool(hit) and hit.get('fp') == fingerprint and time.time() - hit.get('at', 0) < REMOTE_COPY_CACHE_TTL
+
+
+def _copy_stamp(dest_path):
+    # relative paths resolve against the remote user's home directory
+    name = hashlib.sha256(dest_path.rstrip('/').encode()).hexdigest()
+    return shlex.quote(f"{REMOTE_COPY_STAMP_DIR}/{name}")
+
+
+def _remote_copy_is_current(ssh_target, dest_path, fingerprint):
+    """One ssh round trip: does dest_path still exist on the remote with our fingerprint's stamp?"""
+    check = f"test -e {shlex.quote(dest_path)} && cat {_copy_stamp(dest_path)}"
+    try:
+        out = subprocess.run(ssh_target + [check], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             timeout=60).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return out.decode('utf-8', errors='replace').strip() == fingerprint
+
+
+def _write_copy_stamp(ssh_target, dest_path, fingerprint):
+    cmd = f"mkdir -p {shlex.quote(REMOTE_COPY_STAMP_DIR)} && printf '%s\\n' {fingerprint} > {_copy_stamp(dest_path)}"
+    try:
+        return subprocess.run(ssh_target + [cmd], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              timeout=60).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def _record_copy(key, fingerprint):
+    try:
+        with _copy_cache_lock:
+            cache = _load_copy_cache()
+            cache[key] = {'fp': fingerprint, 'at': time.time()}
+            os.makedirs(os.path.dirname(REMOTE_COPY_CACHE), exist_ok=True)
+            tmp = f"{REMOTE_COPY_CACHE}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp, REMOTE_COPY_CACHE)
+    except OSError as e:
+        print('Failed to update remote copy cache', e)
+
+
+def _tar_pipe_upload(src_dir, dest_path, host, user, port=None, key_path=None, known_hosts=None, timeout=None,
+                     allow_insecure=None):
+    """Stream src_dir's contents into dest_path as one compressed tar over a single ssh session,
+    instead of scp's per-file round trips. Compression follows REMOTE_COPY_COMPRESS.
+    Returns True on success."""
+    ssh_args = _ssh_base_args(key_path=key_path, port=port, known_hosts=known_hosts, allow_insecure=allow_insecure)
+    mode = _copy_compression('tar')
+    dest = shlex.quote(dest_path)
+    if mode == 'zstd':
+        remote_cmd = f"mkdir -p {dest} && zstd -dcq | tar -xf - -C {dest}"
+    else:
+        remote_cmd = f"mkdir -p {dest} && tar -x{'z' if mode == 'zlib' else ''}f - -C {dest}"
+    procs = [subprocess.Popen(['tar', '-czf' if mode == 'zlib' else '-cf', '-', '-C', src_dir, '.'],
+                              stdout=subprocess.PIPE)]
+    try:
+        if mode == 'zstd':
+            procs.append(subprocess.Popen(['zstd', '-3', '-q', '-c'], stdin=procs[-1].stdout, stdout=subprocess.PIPE))
+            procs[-2].stdout.close()
+        ssh = subprocess.Popen(ssh_args + [f"{user}@{host}", remote_cmd], stdin=procs[-1].stdout)
+    finally:
+        # ssh holds the pipe now; dropping ours lets tar/zstd see SIGPIPE if ssh dies
+        procs[-1].stdout.close()
+    try:
+        ssh_rc = ssh.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        for p in [ssh] + procs:
+            p.kill()
+            p.wait()
+        print(f'remote_copy tar pipe timed out after {timeout}s')
+        return False
+    rcs = [p.wait() for p in procs]
+    if any(rcs) or ssh_rc != 0:
+        print('remote_copy tar pipe failed:', ' '.join(p.args[0] for p in procs), rcs, 'ssh', ssh_rc)
+        return False
+    return True
 
 
-def remote_copy(src, dest_path, host, user, port=None, key_path=None, known_hosts=None):
-    """Copy local src (file or directory) to remote host:path using rsync/scp.
-    dest_path is remote absolute path. Returns True on success.
+def remote_copy(src, dest_path, host, user, port=None, key_path=None, known_hosts=None, timeout=None):
+    """Copy local src (file or directory) to remote host:path using rsync, a tar pipe or scp.
+    dest_path is remote absolute path. Returns True on success; False on failure or when the copy
+    runs past timeout (default REMOTE_COPY_TIMEOUT seconds).
     Requires known_hosts or REMOTE_ALLOW_INSECURE_SSH=true.
     """
-    # Verify known_hosts or allow insecure
-    allow_insecure = os.environ.get('REMOTE_ALLOW_INSECURE_SSH', '').lower() == 'true'
-    if not known_hosts and not allow_insecure:
-        raise RuntimeError('remote_copy: known_hosts not provided. Set REMOTE_*_KNOWN_HOSTS or REMOTE_ALLOW_INSECURE_SSH=true')
+    allow_insecure = _resolve_ssh_security(known_hosts, 'remote_copy')
 
+    if timeout is None:
+        timeout = REMOTE_COPY_TIMEOUT
+    cache_key = f"{user}@{host}:{port or 22}:{dest_path}"
+    fingerprint = _tree_fingerprint(src)
+    ssh_target = _ssh_base_args(key_path=key_path, port=port, known_hosts=known_hosts,
+                                allow_insecure=allow_insecure) + [f"{user}@{host}"]
+    _remember_master(user, host, port)
+    if _copy_is_current(cache_key, fingerprint) and _remote_copy_is_current(ssh_target, dest_path, fingerprint):
+        return True
     # Prefer rsync if available
-    rsync = shutil.which('rsync')
-    scp = shutil.which('scp')
+    rsync = _which('rsync')
+    scp = _which('scp')
     if rsync:
         ssh_opts = ''
         if key_path:
@@ -86,7 +373,23 @@ def remote_copy(src, dest_path, host, user, port=None, key_path=None, known_host
             ssh_opts += f" -o UserKnownHostsFile={known_hosts} -o StrictHostKeyChecking=yes"
         else:
             ssh_opts += " -o StrictHostKeyChecking=no"
-        cmd = ['rsync', '-a', '--delete', '-e', ssh_opts, src.rstrip('/') + '/', f"{user}@{host}:{dest_path}"]
+        ssh_opts += ''.join(f" {opt}" for opt in _control_master_opts())
+        if os.path.isdir(src):
+            # single compressed rsync over the (shared) SSH connection for the whole tree
+            cmd = ['rsync', '-a', *_rsync_compress_flags(), '--delete', '-e', ssh_opts, src.rstrip('/') + '/',
+                   f"{user}@{host}:{dest_path}"]
+        elif os.path.getsize(src) > REMOTE_COPY_WHOLE_FILE_BYTES:
+            # big artifacts: skip the delta scan and zlib, stream the bytes straight into place
+            cmd = ['rsync', '-a', '--inplace', '--whole-file', '-e', ssh_opts, src, f"{user}@{host}:{dest_path}"]
+        else:
+            cmd = ['rsync', '-a', *_rsync_compress_flags(), '-e', ssh_opts, src, f"{user}@{host}:{dest_path}"]
+    elif os.path.isdir(src) and _which('tar'):
+        # no rsync: ship the tree as one tar stream rather than scp -r's file-by-file copy
+        ok = _tar_pipe_upload(src, dest_path, host, user, port=port, key_path=key_path, known_hosts=known_hosts,
+                              timeout=timeout, allow_insecure=allow_insecure)
+        if ok and _write_copy_stamp(ssh_target, dest_path, fingerprint):
+            _record_copy(cache_key, fingerprint)
+        return ok
     elif scp:
         cmd = [scp, '-r']
         if key_path:
@@ -97,28 +400,53 @@ def remote_copy(src, dest_path, host, user, port=None, key_path=None, known_host
             cmd += ['-o', f'UserKnownHostsFile={known_hosts}', '-o', 'StrictHostKeyChecking=yes']
         else:
             cmd += ['-o', 'StrictHostKeyChecking=no']
+        cmd += _control_master_opts()
         cmd += [src, f"{user}@{host}:{dest_path}"]
     else:
         raise RuntimeError('No rsync or scp available in container')
 
     try:
-        subprocess.check_call(cmd)
+        # run() kills and reaps the child on timeout; stderr is kept for the failure message
+        subprocess.run(cmd, check=True, timeout=timeout, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if _write_copy_stamp(ssh_target, dest_path, fingerprint):
+            _record_copy(cache_key, fingerprint)
         return True
+    except subprocess.TimeoutExpired:
+        print(f'remote_copy timed out after {timeout}s:', cmd[0])
+        return False
     except subprocess.CalledProcessError as e:
-        print('remote_copy failed:', e)
+        print('remote_copy failed:', e, (e.stderr or b'').decode('utf-8', errors='replace').strip())
         return False
 
 
-def remote_run(cmd, host, user, port=None, key_path=None, known_hosts=None, cwd=None, timeout=300):
+# Upper bound for one remote_copy (rsync/tar/scp); a blackholed connection fails instead of hanging
+REMOTE_COPY_TIMEOUT = int(os.environ.get('REMOTE_COPY_TIMEOUT', '1800'))
+
+# Only the tail of a remote command's output is kept; a chatty docker compose build can't grow memory
+REMOTE_OUTPUT_TAIL_BYTES = int(os.environ.get('REMOTE_OUTPUT_TAIL_BYTES', str(256 * 1024)))
+
+
+def _drain(stream, tail, on_line):
+    size = 0
+    for line in iter(stream.readline, b''):
+        tail.append(line)
+        size += len(line)
+        while size > REMOTE_OUTPUT_TAIL_BYTES and len(tail) > 1:
+            size -= len(tail.popleft())
+        if on_line:
+            on_line(line.decode('utf-8', errors='replace'))
+    stream.close()
+
+
+def remote_run(cmd, host, user, port=None, key_path=None, known_hosts=None, cwd=None, timeout=300, on_line=None):
     """Execute a command string on remote host via ssh. Returns (returncode, stdout+stderr)
+    Output is streamed: on_line (if given) sees each line as it arrives, and the returned text is
+    the last REMOTE_OUTPUT_TAIL_BYTES of it. On timeout the ssh process is killed and rc is -1.
     Requires known_hosts or REMOTE_ALLOW_INSECURE_SSH=true.
     """
-    # Validate known_hosts presence
-    allow_insecure = os.environ.get('REMOTE_ALLOW_INSECURE_SSH', '').lower() == 'true'
-    if not known_hosts and not allow_insecure:
-        raise RuntimeError('remote_run: known_hosts not provided. Set REMOTE_*_KNOWN_HOSTS or REMOTE_ALLOW_INSECURE_SSH=true')
-
-    ssh_args = _ssh_base_args(key_path=key_path, port=port, known_hosts=known_hosts)
+    allow_insecure = _resolve_ssh_security(known_hosts, 'remote_run')
+    ssh_args = _ssh_base_args(key_path=key_path, port=port, known_hosts=known_hosts, allow_insecure=allow_insecure)
+    _remember_master(user, host, port)
     ssh_args += [f"{user}@{host}"]
     if cwd:
         remote_cmd = f"cd {cwd} && {cmd}"
@@ -126,12 +454,43 @@ def remote_run(cmd, host, user, port=None, key_path=None, known_hosts=None, cwd=
         remote_cmd = cmd
     full = ssh_args + [remote_cmd]
     try:
-        out = subprocess.check_output(full, stderr=subprocess.STDOUT, timeout=timeout)
-        return 0, out.decode('utf-8', errors='replace')
-    except subprocess.CalledProcessError as e:
-        return e.returncode, (e.output.decode('utf-8', errors='replace') if e.output else str(e))
+        proc = subprocess.Popen(full, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     except Exception as e:
         return -1, str(e)
+    tail = deque()
+    reader = threading.Thread(target=_drain, args=(proc.stdout, tail, on_line), daemon=True)
+    reader.start()
+    try:
+        rc = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        reader.join(1)
+        return -1, b''.join(tail).decode('utf-8', errors='replace') + f"\n[timed out after {timeout}s]"
+    reader.join()
+    return rc, b''.join(tail).decode('utf-8', errors='replace')
+
+
+def warm_hosts(targets):
+    """Open the ControlMaster connection to each target in the background (ssh -fN) so the
+    first real remote_run/remote_copy finds the socket ready instead of paying the handshake.
+    targets: dicts with host, user and optionally port, key_path, known_hosts. Only runs when
+    REMOTE_SSH_PREWARM=true and multiplexing is enabled; masters are closed at exit."""
+    if os.environ.get('REMOTE_SSH_PREWARM', '').lower() != 'true' or not _control_master_enabled():
+        return
+    for t in targets:
+        host, user, port = t.get('host'), t.get('user'), t.get('port')
+        if not host or not user:
+            continue
+        try:
+            args = _ssh_base_args(key_path=t.get('key_path'), port=port, known_hosts=t.get('known_hosts'))
+            # -f backgrounds after authentication, so this returns without waiting on the handshake
+            subprocess.Popen(args + ['-fN', f"{user}@{host}"], stdin=subprocess.DEVNULL,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            _remember_master(user, host, port)
+        except Exception as e:
+            print('ssh prewarm failed for', host, e)
+
 
 # New helper: copy secrets and compose_override when doing a remote_copy of a task
 